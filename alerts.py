@@ -0,0 +1,182 @@
+import asyncio
+import bisect
+import json
+import os
+
+from metrics import metrics
+
+
+class ThresholdIndex:
+    """Alert thresholds of one coin, kept sorted by price.
+
+    An alert fires when the price falls to its threshold or below, so the
+    alerts matching a tick are always a tail of the sorted list and are
+    found with one bisection.
+    """
+
+    def __init__(self):
+        self.entries = []  # (threshold, key) tuples in ascending order
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, threshold, key):
+        bisect.insort(self.entries, (threshold, key))
+
+    def remove(self, threshold, key):
+        index = bisect.bisect_left(self.entries, (threshold, key))
+        if index < len(self.entries) and self.entries[index] == (threshold, key):
+            del self.entries[index]
+
+    def pop_matches(self, price):
+        """Removes and returns the keys of all thresholds at or above `price`."""
+
+        index = bisect.bisect_left(self.entries, (price,))
+        matched = self.entries[index:]
+        del self.entries[index:]
+        return [key for _, key in matched]
+
+
+def format_alert(coin, timeframe, threshold, price):
+    return (f"🔔 {coin} reached the {timeframe} entry zone {threshold} $.\n"
+            f"Current price: {price} $")
+
+
+class AlertManager:
+    """One-shot price alerts on the entry zone of a coin and timeframe.
+
+    Each user has at most one alert per (coin, timeframe). Price ticks are
+    matched through a ThresholdIndex per coin and notifications are queued
+    for a few sender tasks that share the broadcaster's rate limits.
+    Subscriptions are saved to `filename` in the background.
+    """
+
+    def __init__(self, broadcaster, filename, senders=4, save_interval=5.0):
+        self.broadcaster = broadcaster
+        self.filename = filename
+        self.senders = senders
+        self.save_interval = save_interval
+        self.subscriptions = {}  # (user_id, coin, timeframe) -> threshold
+        self.indexes = {}
+        self.queue = asyncio.Queue()
+        self._dirty = False
+        self._writing = None
+        self._tasks = []
+
+    def load(self):
+        """Loads saved subscriptions and rebuilds the indexes."""
+
+        try:
+            with open(self.filename, 'r') as file:
+                rows = json.load(file)
+        except (FileNotFoundError, ValueError):
+            rows = []
+        for row in rows:
+            self._add(row['user_id'], row['coin'], row['timeframe'], row['threshold'])
+        return self
+
+    def _add(self, user_id, coin, timeframe, threshold):
+        self.subscriptions[(user_id, coin, timeframe)] = threshold
+        index = self.indexes.get(coin)
+        if index is None:
+            index = self.indexes[coin] = ThresholdIndex()
+        index.add(threshold, (user_id, timeframe))
+
+    def subscribe(self, user_id, coin, timeframe, threshold):
+        """Alerts `user_id` once the price of `coin` falls to `threshold`."""
+
+        self.unsubscribe(user_id, coin, timeframe)
+        self._add(user_id, coin, timeframe, threshold)
+        self._dirty = True
+
+    def unsubscribe(self, user_id, coin, timeframe):
+        """Removes an alert. Returns True if there was one."""
+
+        threshold = self.subscriptions.pop((user_id, coin, timeframe), None)
+        if threshold is None:
+            return False
+        self.indexes[coin].remove(threshold, (user_id, timeframe))
+        self._dirty = True
+        return True
+
+    def user_alerts(self, user_id):
+        """Returns [(coin, timeframe, threshold)] of a user's alerts."""
+
+        return sorted((coin, timeframe, threshold)
+                      for (uid, coin, timeframe), threshold in self.subscriptions.items()
+                      if uid == user_id)
+
+    def on_tick(self, coin, price):
+        """Matches a price tick and queues notifications for the alerts it fires."""
+
+        index = self.indexes.get(coin)
+        if not index:
+            return 0
+        matched = index.pop_matches(price)
+        for user_id, timeframe in matched:
+            threshold = self.subscriptions.pop((user_id, coin, timeframe))
+            self.queue.put_nowait(
+                (user_id, format_alert(coin, timeframe, threshold, price)))
+        if matched:
+            self._dirty = True
+            metrics.inc('alerts_fired_total', len(matched))
+        return len(matched)
+
+    async def _send(self):
+        while True:
+            user_id, text = await self.queue.get()
+            try:
+                outcome = await self.broadcaster.send(user_id, text)
+                metrics.inc('alert_notifications_total', outcome=outcome)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, rows):
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as file:
+            json.dump(rows, file)
+        os.replace(tmp_filename, self.filename)
+
+    async def save(self):
+        """Writes the subscriptions to disk from an executor thread if they changed."""
+
+        if not self._dirty:
+            return
+        self._dirty = False
+        rows = [{'user_id': user_id, 'coin': coin, 'timeframe': timeframe,
+                 'threshold': threshold}
+                for (user_id, coin, timeframe), threshold in self.subscriptions.items()]
+        loop = asyncio.get_event_loop()
+        try:
+            with metrics.timer('disk_io_seconds', op='alerts_save'):
+                # Shielded so close() can wait for a write its cancellation interrupted
+                self._writing = loop.run_in_executor(None, self._write, rows)
+                await asyncio.shield(self._writing)
+        except OSError as e:
+            self._dirty = True  # Retry on the next save
+            print(f"Error saving alerts: {str(e)}")
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await self.save()
+
+    def start(self):
+        """Starts the sender and save tasks."""
+
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._send())
+                           for _ in range(self.senders)]
+            self._tasks.append(asyncio.ensure_future(self._save_periodically()))
+
+    async def close(self):
+        """Stops the background tasks and saves the subscriptions."""
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        self._dirty = True
+        await self.save()
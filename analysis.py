@@ -0,0 +1,221 @@
+import asyncio
+import io
+import os
+import warnings
+
+import numpy as np
+
+from metrics import metrics
+
+# Horizon of each timeframe, in seconds
+HORIZONS = {
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'month': 30 * 24 * 60 * 60,
+}
+# How many horizons of history the support zone is taken from
+LOOKBACK_HORIZONS = 4
+# Quantile of the lows that marks the support zone
+SUPPORT_QUANTILE = 0.1
+# Stop and take distances in units of horizon-scaled volatility
+STOP_VOLATILITY = 1.0
+TAKE_VOLATILITY = 3.0
+
+COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+
+class CandleHistory:
+    """OHLCV candles of one coin, read incrementally from a CSV file.
+
+    The file has a header line and rows of
+    timestamp,open,high,low,close,volume with ascending timestamps.
+    Only bytes appended since the last read are parsed. Malformed rows
+    are skipped and reported, the others are kept.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.size = 0
+        self._data = np.empty((0, len(COLUMNS)))
+
+    @property
+    def candles(self):
+        return self._data[:self.size]
+
+    @property
+    def last_timestamp(self):
+        return self._data[self.size - 1, 0] if self.size else None
+
+    def refresh(self):
+        """Parses rows appended since the last call. Returns True if any were."""
+
+        with open(self.filename, 'rb') as file:
+            file.seek(self.offset)
+            chunk = file.read()
+        # Leave a trailing partial line for the next refresh
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return False
+        text = chunk[:end].decode(errors='replace')
+        if self.offset == 0:
+            text = text.split('\n', 1)[1] if '\n' in text else ''
+        rows = self._parse(text)
+        # Only now, so a failed read is retried instead of losing the chunk
+        self.offset += end
+        if not len(rows):
+            return False
+        self._append(rows)
+        return True
+
+    def _parse(self, text):
+        """Returns the well-formed rows of `text`, reporting how many were skipped."""
+
+        lines = sum(1 for line in text.split('\n') if line.strip())
+        if not lines:
+            return np.empty((0, len(COLUMNS)))
+        with warnings.catch_warnings():
+            # Rows with a wrong column count, counted below instead
+            warnings.simplefilter('ignore')
+            rows = np.genfromtxt(io.StringIO(text), delimiter=',', ndmin=2,
+                                 usecols=range(len(COLUMNS)), invalid_raise=False)
+        # Fields that are not numbers parse as NaN
+        rows = rows[~np.isnan(rows).any(axis=1)] if len(rows) else np.empty((0, len(COLUMNS)))
+        if len(rows) < lines:
+            print(f"Skipped {lines - len(rows)} malformed rows in {self.filename}")
+        return rows
+
+    def _append(self, rows):
+        needed = self.size + len(rows)
+        if needed > len(self._data):
+            # Grow geometrically so appends stay amortised O(1)
+            grown = np.empty((max(needed, 2 * len(self._data)), len(COLUMNS)))
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = rows
+        self.size = needed
+
+
+def lookback_window(candles, horizon):
+    """Returns the candles of the last LOOKBACK_HORIZONS horizons, at least two."""
+
+    timestamps = candles[:, 0]
+    start = np.searchsorted(timestamps, timestamps[-1] - LOOKBACK_HORIZONS * horizon)
+    return candles[max(0, min(start, len(candles) - 2)):]
+
+
+def compute_levels(candles, horizon):
+    """Computes the entry zone and stop/take percentages for one horizon.
+
+    The entry is the SUPPORT_QUANTILE quantile of the lows over the last
+    LOOKBACK_HORIZONS horizons. Stop and take are set from the average true
+    range, scaled from the candle interval to the horizon.
+    """
+
+    if len(candles) < 2:
+        return None
+
+    interval = float(np.median(np.diff(candles[:, 0])))
+    if interval <= 0:
+        return None
+    window = lookback_window(candles, horizon)
+    high, low, close = window[:, 2], window[:, 3], window[:, 4]
+
+    entry = float(np.quantile(low, SUPPORT_QUANTILE))
+    previous_close = close[:-1]
+    true_range = np.maximum.reduce([
+        high[1:] - low[1:],
+        np.abs(high[1:] - previous_close),
+        np.abs(low[1:] - previous_close),
+    ])
+    volatility = float(true_range.mean()) * np.sqrt(max(horizon / interval, 1.0))
+    if entry <= 0:
+        return None
+    return {
+        'price': round(entry, 8),
+        'stop': round(float(STOP_VOLATILITY * volatility / entry * 100), 1),
+        'take': round(float(TAKE_VOLATILITY * volatility / entry * 100), 1),
+    }
+
+
+class AnalysisEngine:
+    """Computes catalog prices and stop/take levels from local OHLCV files.
+
+    Results are cached per (coin, timeframe, last candle), so a refresh only
+    recomputes coins whose history file has grown.
+    """
+
+    def __init__(self, history_dir):
+        self.history_dir = history_dir
+        self.histories = {}
+        self.cache = {}
+        # The periodic refresh and /refresh_analysis must not read the same files at once
+        self._lock = asyncio.Lock()
+
+    def _history(self, coin):
+        history = self.histories.get(coin)
+        if history is None:
+            filename = os.path.join(self.history_dir, f"{coin}.csv")
+            if not os.path.exists(filename):
+                return None
+            history = self.histories[coin] = CandleHistory(filename)
+        return history
+
+    def levels(self, coin, timeframe):
+        """Returns the cached levels of a coin and timeframe, computing them if needed."""
+
+        history = self._history(coin)
+        if history is None or not history.size:
+            return None
+        key = (coin, timeframe, history.last_timestamp)
+        if key not in self.cache:
+            self.cache[key] = compute_levels(history.candles, HORIZONS[timeframe])
+        return self.cache[key]
+
+    def chart_candles(self, coin, timeframe):
+        """Returns (last timestamp, candles) charted for a coin and timeframe, or None."""
+
+        history = self._history(coin)
+        if history is None or history.size < 2:
+            return None
+        return history.last_timestamp, lookback_window(history.candles, HORIZONS[timeframe])
+
+    def refresh(self, coins):
+        """Reads new candles and returns {coin: {timeframe: levels}} for changed coins."""
+
+        changed = {}
+        for coin in coins:
+            history = self._history(coin)
+            if history is None:
+                continue
+            try:
+                grown = history.refresh()
+            except (OSError, ValueError) as e:
+                print(f"Error reading history of {coin}: {str(e)}")
+                continue
+            if not grown:
+                continue
+            # Drop results for older candles of this coin
+            self.cache = {key: value for key, value in self.cache.items()
+                          if key[0] != coin}
+            levels = {timeframe: self.levels(coin, timeframe) for timeframe in HORIZONS}
+            changed[coin] = {timeframe: value for timeframe, value in levels.items()
+                             if value is not None}
+        return changed
+
+    async def refresh_catalog(self, catalog):
+        """Refreshes every coin with a history file and commits new levels to the catalog."""
+
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            with metrics.timer('analysis_refresh_seconds'):
+                changed = await loop.run_in_executor(None, self.refresh, list(catalog.data))
+            edit = catalog.begin()
+            for coin, timeframes in changed.items():
+                for timeframe, levels in timeframes.items():
+                    current = catalog.data[coin][timeframe]
+                    if any(current.get(field) != value for field, value in levels.items()):
+                        edit.set(coin, timeframe, **levels)
+            if edit.changes:
+                await catalog.commit(edit)
+            return len(edit.changes)
@@ -0,0 +1,201 @@
+import os
+
+import numpy as np
+
+from analysis import HORIZONS, CandleHistory
+from catalog import TIMEFRAMES
+
+# Same layout as recommendations.RECORD
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('timeframe', 'u1'), ('price', '<f8'),
+                         ('stop', '<f4'), ('take', '<f4')])
+# The entry zone must be reached within one horizon of the recommendation,
+# and the position is closed after HOLD_HORIZONS horizons without stop or take
+FILL_HORIZONS = 1
+HOLD_HORIZONS = 4
+
+OUTCOMES = ['unfilled', 'take', 'stop', 'expired', 'open']
+
+
+def read_recommendations(filename):
+    """Reads a recommendation file, ignoring a torn record at its end."""
+
+    size = os.path.getsize(filename) // RECORD_DTYPE.itemsize
+    return np.fromfile(filename, dtype=RECORD_DTYPE, count=size)
+
+
+def sparse_table(values, reduce):
+    """Returns a (levels, n) array whose row k holds `reduce` over values[i:i + 2**k].
+
+    Windows running past the end are truncated, queries never use them.
+    """
+
+    levels = [values]
+    step = 1
+    while 2 * step <= len(values):
+        previous = levels[-1]
+        shifted = np.concatenate([previous[step:], previous[-step:]])
+        levels.append(reduce(previous, shifted))
+        step *= 2
+    return np.stack(levels)
+
+
+def first_touch(table, start, end, threshold, touched):
+    """Returns the first index in [start, end) whose value is touched, or `end`.
+
+    `table` is a sparse table of range minima (with touched=np.less_equal)
+    or maxima (with np.greater_equal). All positions advance together by
+    binary lifting over blocks that are not touched, so the cost is
+    O(n log m) for n queries over m candles.
+    """
+
+    position = start.copy()
+    for level in range(len(table) - 1, -1, -1):
+        step = 1 << level
+        fits = position + step <= end
+        block = table[level, np.minimum(position, table.shape[1] - 1)]
+        position = np.where(fits & ~touched(block, threshold), position + step, position)
+    return position
+
+
+def range_reduce(table, reduce, first, last):
+    """Returns `reduce` over values[first:last + 1] for arrays of ranges."""
+
+    level = np.log2(last - first + 1).astype(np.int64)
+    return reduce(table[level, first], table[level, last - (1 << level) + 1])
+
+
+def replay(candles, recommendations):
+    """Replays recommendations against candles, all at once.
+
+    A recommendation fills at the first candle from its time whose low
+    reaches the entry price, then ends at the first candle whose low
+    reaches the stop or whose high reaches the take. A candle that
+    reaches both counts as a stop. Returns the outcome index (into
+    OUTCOMES), seconds from recommendation to take, and the largest
+    drawdown below the entry in percent, per recommendation.
+    """
+
+    timestamps, high, low = candles[:, 0], candles[:, 2], candles[:, 3]
+    count = len(recommendations)
+    minima = sparse_table(low, np.minimum)
+    maxima = sparse_table(high, np.maximum)
+    horizon = np.array([HORIZONS[timeframe] for timeframe in TIMEFRAMES])[
+        recommendations['timeframe']]
+    price = recommendations['price']
+    stop = price * (1 - recommendations['stop'] / 100)
+    take = price * (1 + recommendations['take'] / 100)
+
+    start = np.searchsorted(timestamps, recommendations['time'])
+    fill_end = np.searchsorted(timestamps, recommendations['time'] + FILL_HORIZONS * horizon)
+    filled_at = first_touch(minima, start, fill_end, price, np.less_equal)
+    filled = filled_at < fill_end
+
+    fill_index = np.minimum(filled_at, len(candles) - 1)
+    hold_end = np.searchsorted(timestamps, timestamps[fill_index] + HOLD_HORIZONS * horizon)
+    hold_end = np.where(filled, hold_end, filled_at)
+    stopped_at = first_touch(minima, filled_at, hold_end, stop, np.less_equal)
+    taken_at = first_touch(maxima, filled_at, hold_end, take, np.greater_equal)
+    exit_at = np.minimum(stopped_at, taken_at)
+
+    outcome = np.zeros(count, dtype=np.int64)
+    outcome[filled & (stopped_at <= taken_at) & (stopped_at < hold_end)] = OUTCOMES.index('stop')
+    outcome[filled & (taken_at < stopped_at)] = OUTCOMES.index('take')
+    unresolved = filled & (exit_at >= hold_end)
+    # Positions whose holding period runs past the last candle are still open
+    outcome[unresolved] = OUTCOMES.index('open')
+    outcome[unresolved & (timestamps[fill_index] + HOLD_HORIZONS * horizon <= timestamps[-1])] = \
+        OUTCOMES.index('expired')
+
+    to_target = np.full(count, np.nan)
+    took = outcome == OUTCOMES.index('take')
+    to_target[took] = timestamps[taken_at[took]] - recommendations['time'][took]
+
+    drawdown = np.full(count, np.nan)
+    last = np.minimum(exit_at, hold_end - 1)[filled]
+    lowest = range_reduce(minima, np.minimum, filled_at[filled], np.maximum(last, filled_at[filled]))
+    drawdown[filled] = np.maximum(0.0, (price[filled] - lowest) / price[filled] * 100)
+    return outcome, to_target, drawdown
+
+
+def summarize(outcome, to_target, drawdown):
+    """Aggregates replayed recommendations into counts, hit rate and averages."""
+
+    counts = np.bincount(outcome, minlength=len(OUTCOMES))
+    summary = dict(zip(OUTCOMES, counts.tolist()))
+    summary['total'] = len(outcome)
+    closed = summary['take'] + summary['stop']
+    summary['hit_rate'] = summary['take'] / closed if closed else None
+    took = ~np.isnan(to_target)
+    summary['median_hours_to_take'] = \
+        float(np.median(to_target[took])) / 3600 if took.any() else None
+    filled = ~np.isnan(drawdown)
+    summary['mean_drawdown'] = float(drawdown[filled].mean()) if filled.any() else None
+    summary['max_drawdown'] = float(drawdown[filled].max()) if filled.any() else None
+    return summary
+
+
+class Backtester:
+    """Replays recorded recommendations against the OHLCV history of each coin."""
+
+    def __init__(self, history_dir, recommendations_dir):
+        self.history_dir = history_dir
+        self.recommendations_dir = recommendations_dir
+        self.histories = {}
+
+    def _candles(self, coin):
+        history = self.histories.get(coin)
+        if history is None:
+            filename = os.path.join(self.history_dir, f"{coin}.csv")
+            if not os.path.exists(filename):
+                return None
+            history = self.histories[coin] = CandleHistory(filename)
+        history.refresh()
+        return history.candles if history.size else None
+
+    def run(self, coins):
+        """Returns {(coin, timeframe): summary} for coins with recommendations and history.
+
+        Blocking, run it in an executor.
+        """
+
+        results = {}
+        for coin in coins:
+            filename = os.path.join(self.recommendations_dir, f"{coin}.bin")
+            if not os.path.exists(filename):
+                continue
+            try:
+                candles = self._candles(coin)
+                recommendations = read_recommendations(filename)
+            except (OSError, ValueError) as e:
+                print(f"Error reading backtest data of {coin}: {str(e)}")
+                continue
+            if candles is None or not len(recommendations):
+                continue
+            outcome, to_target, drawdown = replay(candles, recommendations)
+            for index, timeframe in enumerate(TIMEFRAMES):
+                selected = recommendations['timeframe'] == index
+                if selected.any():
+                    results[(coin, timeframe)] = summarize(
+                        outcome[selected], to_target[selected], drawdown[selected])
+        return results
+
+
+def _format_value(value, template):
+    return template.format(value) if value is not None else "-"
+
+
+def format_backtest(results):
+    """Formats backtest summaries for the /backtest command."""
+
+    lines = []
+    for (coin, timeframe), summary in results.items():
+        lines.append(
+            f"{coin} ({timeframe}): {summary['total']} sent, "
+            f"{summary['total'] - summary['unfilled']} filled, "
+            f"{summary['take']} take / {summary['stop']} stop / "
+            f"{summary['expired'] + summary['open']} open or expired\n"
+            f"  hit rate {_format_value(summary['hit_rate'], '{:.0%}')}, "
+            f"to take {_format_value(summary['median_hours_to_take'], '{:.1f}h')} (median), "
+            f"drawdown {_format_value(summary['mean_drawdown'], '{:.1f}%')} mean, "
+            f"{_format_value(summary['max_drawdown'], '{:.1f}%')} max")
+    return "\n".join(lines)
@@ -0,0 +1,198 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+# Smallest valid PNG, served for files that were never uploaded
+BLANK_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082')
+
+SEND_METHODS = {'sendmessage', 'sendphoto', 'sendmediagroup', 'editmessagetext',
+                'copymessage'}
+
+
+class FakeTelegram:
+    """In-memory stand-in for the Telegram Bot API, used by the benchmarks.
+
+    Implements just enough of the API for the bot's handlers: getMe,
+    getUpdates, sendMessage, sendPhoto, sendMediaGroup, getFile,
+    editMessageText, copyMessage, answerCallbackQuery and the webhook calls, plus file
+    downloads. Send calls can be delayed by a configurable latency, and a
+    configurable share of them fails with a 429 flood error.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, flood_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = []
+        self.files = {}
+        self.updates = asyncio.Queue()
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner = None
+
+    # Helpers for the benchmark driver
+
+    def push_update(self, update):
+        """Queues an update for getUpdates, assigning its update_id."""
+
+        update.setdefault('update_id', next(self._update_ids))
+        self.updates.put_nowait(update)
+        return update
+
+    def add_file(self, content):
+        """Stores file bytes and returns a file_id that getFile can resolve."""
+
+        file_id = f"file{next(self._file_ids)}"
+        self.files[file_id] = content
+        return file_id
+
+    def count(self, method, chat_id=None, token=None):
+        method = method.lower()
+        return sum(1 for call in self.calls
+                   if call['method'] == method
+                   and (chat_id is None or call['chat_id'] == chat_id)
+                   and (token is None or call['token'] == token))
+
+    # API implementation
+
+    def _message(self, chat_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    def _photo(self, content):
+        file_id = self.add_file(content)
+        return [{'file_id': file_id, 'file_unique_id': file_id,
+                 'width': 1, 'height': 1, 'file_size': len(content)}]
+
+    async def _upload(self, value):
+        """Returns the bytes of an uploaded file or of an existing file_id."""
+
+        if isinstance(value, web.FileField):
+            return value.file.read()
+        return self.files.get(value, BLANK_PNG)
+
+    async def _dispatch(self, method, params):
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench',
+                    'username': 'bench_bot'}
+        if method in ('deletewebhook', 'setwebhook', 'answercallbackquery',
+                      'answerinlinequery', 'setmycommands'):
+            return True
+        if method == 'getwebhookinfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method == 'getupdates':
+            return await self._get_updates(params)
+        chat_id = int(params.get('chat_id', 0) or 0)
+        if method == 'sendmessage':
+            return self._message(chat_id, text=params.get('text', ''))
+        if method == 'editmessagetext':
+            return self._message(chat_id, text=params.get('text', ''))
+        if method == 'editmessagereplymarkup':
+            return self._message(chat_id, text='menu')
+        if method == 'sendphoto':
+            content = await self._upload(params.get('photo'))
+            return self._message(chat_id, photo=self._photo(content),
+                                 caption=params.get('caption', ''))
+        if method == 'copymessage':
+            return {'message_id': next(self._message_ids)}
+        if method == 'sendmediagroup':
+            return await self._send_media_group(chat_id, params)
+        if method == 'getfile':
+            file_id = params.get('file_id')
+            return {'file_id': file_id, 'file_unique_id': file_id,
+                    'file_path': f"photos/{file_id}.png",
+                    'file_size': len(self.files.get(file_id, BLANK_PNG))}
+        raise web.HTTPNotFound()
+
+    async def _send_media_group(self, chat_id, params):
+        media = json.loads(params.get('media', '[]'))
+        messages = []
+        for item in media:
+            value = item.get('media', '')
+            if value.startswith('attach://'):
+                value = params.get(value[len('attach://'):])
+            content = await self._upload(value)
+            messages.append(self._message(chat_id, photo=self._photo(content),
+                                          caption=item.get('caption', '')))
+        return messages
+
+    async def _get_updates(self, params):
+        timeout = float(params.get('timeout', 0) or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout or 0.01))
+        except asyncio.TimeoutError:
+            return updates
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def handle_api(self, request):
+        method = request.match_info['method'].lower()
+        params = dict(await request.post())
+        params.update(request.query)
+        if method in SEND_METHODS:
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + random.random() * self.jitter)
+            if random.random() < self.flood_rate:
+                return web.json_response({
+                    'ok': False, 'error_code': 429,
+                    'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after}}, status=429)
+        self.calls.append({'method': method, 'time': time.monotonic(),
+                           'chat_id': int(params.get('chat_id', 0) or 0),
+                           'token': request.match_info['token']})
+        result = await self._dispatch(method, params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_file(self, request):
+        file_id = request.match_info['path'].rsplit('/', 1)[-1].split('.')[0]
+        return web.Response(body=self.files.get(file_id, BLANK_PNG),
+                            content_type='image/png')
+
+    def app(self):
+        # Telegram accepts photo uploads of up to 10 MB
+        app = web.Application(client_max_size=20 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle_api)
+        app.router.add_get('/bot{token}/{method}', self.handle_api)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        """Starts serving and returns the base URL for the bot."""
+
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the fake Telegram Bot API server.")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency_ms / 1000, flood_rate=args.flood_rate)
+    web.run_app(fake.app(), host='127.0.0.1', port=args.port)
@@ -0,0 +1,349 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from fake_telegram import FakeTelegram
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+ADMIN_ID = 1000
+ADMIN_PASSWORD = 'bench'
+USER_ID_BASE = 2000000
+
+
+def prepare_workdir(api_url, bots=1):
+    """Creates a scratch directory with a copy of the catalog and a bench config.
+
+    Bots beyond the first are hosted through the BOTS setting.
+    """
+
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    shutil.copy(os.path.join(REPO_DIR, 'crypto_data.csv'), workdir)
+    shutil.copytree(os.path.join(REPO_DIR, 'images'), os.path.join(workdir, 'images'))
+    with open(os.path.join(workdir, 'config.json'), 'w') as config_file:
+        json.dump({
+            'API_TOKEN': BENCH_TOKEN,
+            'ADMIN_PASSWORD': ADMIN_PASSWORD,
+            'CSV_FILE': 'crypto_data.csv',
+            'IMAGE_DIR': 'images',
+            'USER_STATS_FILE': 'user_stats.csv',
+            'USER_IDS_FILE': 'user_ids.txt',
+            'ADMIN_USER_IDS': [ADMIN_ID],
+            'TELEGRAM_API_URL': api_url,
+            'BOTS': [{'NAME': f"bench{i}", 'API_TOKEN': f"{123456 + i}:BENCHMARK-TOKEN"}
+                     for i in range(1, bots)],
+        }, config_file)
+    return workdir
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Driver:
+    """Builds updates for scripted journeys and times their handling."""
+
+    def __init__(self, app, fake):
+        self.app = app
+        self.fake = fake
+        self.latencies = {}
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self.handled = 0
+        self.errors = 0
+        self.flood_waits = 0
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+    def _message(self, user_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+        }
+        message.update(fields)
+        return message
+
+    def text(self, user_id, text):
+        fields = {'text': text}
+        if text.startswith('/'):
+            command = text.split()[0]
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                   'length': len(command)}]
+        return {'message': self._message(user_id, **fields)}
+
+    def photo(self, user_id, file_id):
+        photo = [{'file_id': file_id, 'file_unique_id': file_id,
+                  'width': 1, 'height': 1}]
+        return {'message': self._message(user_id, photo=photo)}
+
+    def callback(self, user_id, data, message=None):
+        return {'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'message': message or self._message(user_id, text='menu'),
+            'data': data,
+        }}
+
+    def inline_query(self, user_id, query, offset=''):
+        return {'inline_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user(user_id),
+            'query': query,
+            'offset': offset,
+        }}
+
+    async def step(self, name, update):
+        """Handles one update and records its latency under `name`."""
+
+        from aiogram import types
+        from aiogram.utils.exceptions import RetryAfter
+
+        update['update_id'] = next(self._update_ids)
+        started = time.perf_counter()
+        try:
+            # A task per update, as in polling: aiogram keeps per-update
+            # state such as the FSM state in context variables
+            await asyncio.ensure_future(self.app.dp.process_update(types.Update(**update)))
+        except RetryAfter:
+            # An injected 429 reached the handler, as it would from Telegram
+            self.flood_waits += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Error handling {name}: {e!r}")
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        self.handled += 1
+
+    async def user_journey(self, user_id, coin, timeframe):
+        await self.step('register', self.text(user_id, 'hi'))
+        await self.step('start', self.text(user_id, '/start'))
+        await self.step('role', self.callback(user_id, 'user'))
+        await self.step('coin', self.callback(user_id, coin))
+        await self.step('timeframe', self.callback(user_id, timeframe))
+        await self.step('go_back', self.callback(user_id, 'go_back'))
+
+    async def all_timeframes(self, user_id, coin):
+        await self.step('all_register', self.text(user_id, 'hi'))
+        await self.step('all_start', self.text(user_id, '/start'))
+        await self.step('all_role', self.callback(user_id, 'user'))
+        await self.step('all_coin', self.callback(user_id, coin))
+        await self.step('all_timeframes', self.callback(user_id, 'all'))
+
+    async def inline_search(self, user_id, coin):
+        """Types a coin name letter by letter into an inline query."""
+
+        for length in range(1, min(len(coin), 4) + 1):
+            await self.step('inline_query', self.inline_query(user_id, coin[:length]))
+
+    async def tap_burst(self, user_id, coin, timeframe, taps):
+        """Taps the same timeframe button `taps` times at once, then once more a second later."""
+
+        await self.step('burst_start', self.text(user_id, '/start'))
+        await self.step('burst_role', self.callback(user_id, 'user'))
+        await self.step('burst_coin', self.callback(user_id, coin))
+        menu = self._message(user_id, text='menu')
+        await asyncio.gather(*[
+            self.step('burst_tap', self.callback(user_id, timeframe, message=menu))
+            for _ in range(taps)])
+        await asyncio.sleep(1.0)
+        await self.step('burst_repeat', self.callback(user_id, timeframe, message=menu))
+
+    async def admin_edit(self, coin, timeframe, price, file_id):
+        await self.step('admin_start', self.text(ADMIN_ID, '/start'))
+        await self.step('admin_role', self.callback(ADMIN_ID, 'admin'))
+        await self.step('admin_password', self.text(ADMIN_ID, ADMIN_PASSWORD))
+        await self.step('admin_coin', self.callback(ADMIN_ID, coin))
+        await self.step('admin_timeframe', self.callback(ADMIN_ID, timeframe))
+        await self.step('admin_price', self.text(ADMIN_ID, str(price)))
+        await self.step('admin_image', self.photo(ADMIN_ID, file_id))
+
+    async def broadcast(self, text):
+        await self.step('send_to_all', self.text(ADMIN_ID, '/send_to_all'))
+        await self.step('send_to_all_text', self.text(ADMIN_ID, text))
+
+
+async def run_concurrently(concurrency, coroutines):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(coroutine):
+        async with semaphore:
+            await coroutine
+
+    await asyncio.gather(*[guarded(coroutine) for coroutine in coroutines])
+
+
+async def run_hosted_bots(bot_main, fake, args, coins, timeframes):
+    """Runs user journeys against every hosted bot at once and reports each one."""
+
+    from aiogram import Bot, Dispatcher
+
+    async def drive(app, driver):
+        # Each bot's updates are built and handled in a context of its own
+        Bot.set_current(app.bot)
+        Dispatcher.set_current(app.dp)
+        await run_concurrently(args.concurrency, [
+            driver.user_journey(USER_ID_BASE + 10 * args.users + i, coins[i % len(coins)],
+                                timeframes[i % len(timeframes)])
+            for i in range(args.users)])
+
+    drivers = [Driver(app, fake) for app in bot_main.apps]
+    photos_before = {app.name: fake.count('sendPhoto', token=app.bot._token)
+                     for app in bot_main.apps}
+    started = time.perf_counter()
+    await asyncio.gather(*[asyncio.ensure_future(drive(app, driver))
+                           for app, driver in zip(bot_main.apps, drivers)])
+    elapsed = time.perf_counter() - started
+    for app, driver in zip(bot_main.apps, drivers):
+        report(f"Hosted bot {app.name}", driver, elapsed)
+        print(f"{fake.count('sendPhoto', token=app.bot._token) - photos_before[app.name]} photos, "
+              f"{len(app.user_registry)} users")
+    print(f"Peak RSS with {len(bot_main.apps)} bots: "
+          f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+def report(title, driver, elapsed):
+    print(f"\n{title}: {driver.handled} updates in {elapsed:.2f}s "
+          f"({driver.handled / elapsed if elapsed else 0:.1f} updates/s, "
+          f"{driver.errors} errors, {driver.flood_waits} flood waits)")
+    print(f"{'step':<18}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in driver.latencies.items():
+        print(f"{name:<18}{len(values):>7}"
+              f"{percentile(values, 0.50) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}"
+              f"{percentile(values, 0.99) * 1000:>10.2f}")
+
+
+async def main(args):
+    fake = FakeTelegram(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                        flood_rate=args.flood_rate)
+    api_url = await fake.start(port=args.port)
+    workdir = prepare_workdir(api_url, args.bots)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import main as bot_main
+    from aiogram import Bot, Dispatcher
+
+    app = bot_main.apps[0]
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+    await bot_main.on_startup([app.dp])
+    await bot_main.startup.ready.wait()
+    driver = Driver(app, fake)
+    coins = list(bot_main.catalog.data)
+    timeframes = ['day', 'week', 'month']
+
+    try:
+        # User journeys
+        started = time.perf_counter()
+        await run_concurrently(args.concurrency, [
+            driver.user_journey(USER_ID_BASE + i, coins[i % len(coins)],
+                                timeframes[i % len(timeframes)])
+            for i in range(args.users)])
+        report("User journeys", driver, time.perf_counter() - started)
+
+        # All three timeframes of a coin as one media group
+        driver.latencies, driver.handled, driver.errors, driver.flood_waits = {}, 0, 0, 0
+        groups_before = fake.count('sendMediaGroup')
+        started = time.perf_counter()
+        await run_concurrently(args.concurrency, [
+            driver.all_timeframes(USER_ID_BASE + args.users + i, coins[i % len(coins)])
+            for i in range(args.users)])
+        report("All timeframes", driver, time.perf_counter() - started)
+        print(f"{fake.count('sendMediaGroup') - groups_before} media groups sent")
+
+        # Inline coin search
+        driver.latencies, driver.handled, driver.errors, driver.flood_waits = {}, 0, 0, 0
+        answers_before = fake.count('answerInlineQuery')
+        started = time.perf_counter()
+        await run_concurrently(args.concurrency, [
+            driver.inline_search(USER_ID_BASE + i, coins[i % len(coins)])
+            for i in range(args.users)])
+        report("Inline search", driver, time.perf_counter() - started)
+        print(f"{fake.count('answerInlineQuery') - answers_before} inline queries answered")
+
+        # Bursts of identical taps, absorbed by the throttling middleware
+        driver.latencies, driver.handled, driver.errors, driver.flood_waits = {}, 0, 0, 0
+        photos_before = fake.count('sendPhoto')
+        copies_before = fake.count('copyMessage')
+        started = time.perf_counter()
+        await run_concurrently(args.concurrency, [
+            driver.tap_burst(USER_ID_BASE + i, coins[i % len(coins)],
+                             timeframes[i % len(timeframes)], args.burst_taps)
+            for i in range(args.burst_users)])
+        report("Tap bursts", driver, time.perf_counter() - started)
+        print(f"{args.burst_users * (args.burst_taps + 1)} taps sent "
+              f"{fake.count('sendPhoto') - photos_before} photos and "
+              f"{fake.count('copyMessage') - copies_before} copies")
+
+        # User journeys spread over every hosted bot
+        if len(bot_main.apps) > 1:
+            await run_hosted_bots(bot_main, fake, args, coins, timeframes)
+
+        # Admin edit flows
+        driver.latencies, driver.handled, driver.errors, driver.flood_waits = {}, 0, 0, 0
+        started = time.perf_counter()
+        await driver.step('admin_register', driver.text(ADMIN_ID, 'hi'))
+        for i in range(args.admin_edits):
+            with open(bot_main.catalog.data[coins[0]]['day']['image'], 'rb') as image:
+                file_id = fake.add_file(image.read())
+            await driver.admin_edit(coins[0], 'day', 100.0 + i, file_id)
+        report("Admin edits", driver, time.perf_counter() - started)
+
+        # Broadcast to every registered user
+        driver.latencies, driver.handled, driver.errors, driver.flood_waits = {}, 0, 0, 0
+        recipients = len(app.user_registry)
+        sent_before = fake.count('sendMessage')
+        started = time.perf_counter()
+        await driver.broadcast('Benchmark broadcast')
+        while app.broadcast_jobs.describe():
+            await asyncio.sleep(0.05)
+            if time.perf_counter() - started > args.broadcast_timeout:
+                print("Broadcast did not finish before the timeout")
+                break
+        elapsed = time.perf_counter() - started
+        sent = fake.count('sendMessage') - sent_before
+        report("Broadcast commands", driver, elapsed)
+        print(f"Broadcast delivered {sent} messages to {recipients} users in "
+              f"{elapsed:.2f}s ({sent / elapsed if elapsed else 0:.1f} messages/s)")
+    finally:
+        await bot_main.on_shutdown([app.dp])
+        await fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the bot's handlers against a local fake Telegram API.")
+    parser.add_argument('--users', type=int, default=200,
+                        help="number of scripted user journeys")
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help="journeys running at the same time")
+    parser.add_argument('--burst-users', type=int, default=50,
+                        help="users tapping the same button repeatedly")
+    parser.add_argument('--burst-taps', type=int, default=5,
+                        help="simultaneous taps per burst")
+    parser.add_argument('--admin-edits', type=int, default=5)
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help="simulated Telegram API latency per send call")
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help="share of send calls that fail with a 429")
+    parser.add_argument('--broadcast-timeout', type=float, default=300.0)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--bots', type=int, default=1,
+                        help="bots hosted by the process, each driven with --users journeys")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,179 @@
+import asyncio
+import time
+
+from aiogram.utils import exceptions
+
+# Telegram allows about 30 messages per second overall and
+# about one message per second to the same chat.
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0
+MAX_RETRIES = 3
+
+
+class TokenBucket:
+    """Async token bucket limiter."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stops handing out tokens for `seconds`, e.g. after a RetryAfter."""
+
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Waits until a token is available and takes it."""
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Spaces out messages sent to the same chat."""
+
+    def __init__(self, interval=PER_CHAT_INTERVAL):
+        self.interval = interval
+        self.next_allowed = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        ready_at = self.next_allowed.get(chat_id, now)
+        self.next_allowed[chat_id] = max(ready_at, now) + self.interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+        if len(self.next_allowed) > 10000:
+            self.next_allowed = {chat: t for chat, t in self.next_allowed.items()
+                                 if t > now}
+
+
+def classify_error(error):
+    """Maps a Telegram error to a delivery outcome name."""
+
+    if isinstance(error, exceptions.BotBlocked):
+        return 'blocked'
+    if isinstance(error, exceptions.UserDeactivated):
+        return 'deactivated'
+    if isinstance(error, exceptions.ChatNotFound):
+        return 'not_found'
+    return 'failed'
+
+
+class BroadcastResult:
+    """Outcome counters of a broadcast."""
+
+    OUTCOMES = ['sent', 'blocked', 'deactivated', 'not_found', 'failed']
+
+    def __init__(self, total):
+        self.total = total
+        self.counts = {outcome: 0 for outcome in self.OUTCOMES}
+        self.started = time.monotonic()
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return (
+            f"Broadcast progress: {self.done}/{self.total} in {elapsed:.0f}s\n"
+            f"Sent: {self.counts['sent']}\n"
+            f"Blocked: {self.counts['blocked']}\n"
+            f"Deactivated: {self.counts['deactivated']}\n"
+            f"Chat not found: {self.counts['not_found']}\n"
+            f"Other errors: {self.counts['failed']}"
+        )
+
+
+class Broadcaster:
+    """Sends a message to many users with bounded concurrency and rate limits."""
+
+    def __init__(self, bot, concurrency=20, rate=GLOBAL_RATE,
+                 progress_interval=30.0):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatLimiter()
+        self.progress_interval = progress_interval
+        # Called with (chat_id, outcome) after every send
+        self.listeners = []
+
+    def _notify(self, chat_id, outcome):
+        for listener in self.listeners:
+            listener(chat_id, outcome)
+        return outcome
+
+    async def send(self, chat_id, message_text):
+        """Sends one message, retrying on flood control. Returns the outcome."""
+
+        for _ in range(MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            await self.chat_limiter.wait(chat_id)
+            try:
+                await self.bot.send_message(chat_id, message_text)
+                return self._notify(chat_id, 'sent')
+            except exceptions.RetryAfter as e:
+                self.bucket.pause(e.timeout)
+            except exceptions.TelegramAPIError as e:
+                outcome = classify_error(e)
+                if outcome == 'failed':
+                    print(f"Error sending message to user {chat_id}: {str(e)}")
+                return self._notify(chat_id, outcome)
+        return self._notify(chat_id, 'failed')
+
+    async def run(self, user_ids, message_text, report_chat_id=None,
+                  on_outcome=None, should_stop=None):
+        """Broadcasts `message_text` and reports progress to `report_chat_id`.
+
+        `on_outcome(user_id, outcome)` is awaited after every recipient, and
+        the broadcast stops early once `should_stop()` returns True.
+        """
+
+        user_ids = list(user_ids)
+        result = BroadcastResult(len(user_ids))
+        pending = iter(user_ids)
+
+        async def worker():
+            for user_id in pending:
+                if should_stop is not None and should_stop():
+                    return
+                outcome = await self.send(user_id, message_text)
+                result.counts[outcome] += 1
+                if on_outcome is not None:
+                    await on_outcome(user_id, outcome)
+
+        reporter = None
+        if report_chat_id is not None:
+            reporter = asyncio.ensure_future(
+                self._report_progress(report_chat_id, result))
+        try:
+            await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+        if report_chat_id is not None:
+            stopped = result.done < result.total
+            header = "Broadcast stopped." if stopped else "Broadcast finished."
+            await self.send(report_chat_id, header + "\n" + result.summary())
+        return result
+
+    async def _report_progress(self, chat_id, result):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self.send(chat_id, result.summary())
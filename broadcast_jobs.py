@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from metrics import metrics
+
+RUNNING = 'running'
+PAUSED = 'paused'
+CANCELLED = 'cancelled'
+DONE = 'done'
+
+
+class BroadcastJob:
+    """A broadcast whose recipients and per-recipient outcomes live on disk.
+
+    Each job is stored as three files in the jobs directory:
+    <job_id>.json holds the message and status, <job_id>.ids the recipient
+    list and <job_id>.log one "user_id,outcome" line per finished recipient.
+    Each line reaches the OS as soon as its send finished, so a restarted
+    job never sends to a recipient twice; fsync is batched.
+    """
+
+    FSYNC_EVERY = 50
+
+    def __init__(self, directory, job_id, meta):
+        self.directory = directory
+        self.job_id = job_id
+        self.meta = meta
+        self._log = None
+        self._unflushed = 0
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, f"{self.job_id}{suffix}")
+
+    @property
+    def status(self):
+        return self.meta['status']
+
+    def save(self):
+        """Writes the job metadata atomically."""
+
+        tmp_filename = self._path('.json.tmp')
+        with open(tmp_filename, 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(tmp_filename, self._path('.json'))
+
+    def set_status(self, status):
+        self.meta['status'] = status
+        self.save()
+
+    def write_recipients(self, user_ids):
+        with open(self._path('.ids'), 'w') as file:
+            for user_id in user_ids:
+                file.write(f"{user_id}\n")
+
+    def read_recipients(self):
+        user_ids = []
+        with open(self._path('.ids'), 'r') as file:
+            for line in file:
+                if line.strip():
+                    user_ids.append(int(line))
+        return user_ids
+
+    def read_outcomes(self):
+        """Returns {user_id: outcome} for recipients already handled."""
+
+        outcomes = {}
+        try:
+            with open(self._path('.log'), 'r') as file:
+                for line in file:
+                    user_id, _, outcome = line.strip().partition(',')
+                    if outcome:
+                        outcomes[int(user_id)] = outcome
+        except FileNotFoundError:
+            pass
+        return outcomes
+
+    def pending_recipients(self):
+        done = self.read_outcomes()
+        return [user_id for user_id in self.read_recipients()
+                if user_id not in done]
+
+    def record(self, user_id, outcome):
+        """Appends and flushes a recipient outcome, syncing to disk every few records."""
+
+        if self._log is None:
+            self._log = open(self._path('.log'), 'a')
+        self._log.write(f"{user_id},{outcome}\n")
+        # Survives the process being killed; fsync guards against power loss
+        self._log.flush()
+        self._unflushed += 1
+        if self._unflushed >= self.FSYNC_EVERY:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self._log is not None:
+            with metrics.timer('disk_io_seconds', op='broadcast_checkpoint'):
+                self._log.flush()
+                os.fsync(self._log.fileno())
+        self._unflushed = 0
+
+    def close(self):
+        self.checkpoint()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+class BroadcastJobManager:
+    """Starts, resumes, pauses and cancels persistent broadcast jobs."""
+
+    def __init__(self, broadcaster, directory='broadcasts'):
+        self.broadcaster = broadcaster
+        self.directory = directory
+        self.jobs = {}
+        self._tasks = {}
+
+    def load(self):
+        """Loads all job metadata from the jobs directory."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json'):
+                continue
+            job_id = filename[:-len('.json')]
+            with open(os.path.join(self.directory, filename), 'r') as file:
+                meta = json.load(file)
+            self.jobs[job_id] = BroadcastJob(self.directory, job_id, meta)
+        return self
+
+    def start(self, message_text, user_ids, report_chat_id=None):
+        """Creates a job for `user_ids` and starts sending it."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        job_id = uuid.uuid4().hex[:8]
+        job = BroadcastJob(self.directory, job_id, {
+            'text': message_text,
+            'report_chat_id': report_chat_id,
+            'status': RUNNING,
+            'created': time.time(),
+        })
+        job.write_recipients(user_ids)
+        job.save()
+        self.jobs[job_id] = job
+        self._spawn(job)
+        return job
+
+    def resume_all(self):
+        """Restarts every job that was running when the process stopped."""
+
+        for job in self.jobs.values():
+            if job.status == RUNNING and job.job_id not in self._tasks:
+                self._spawn(job)
+
+    def resume(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in (RUNNING, PAUSED):
+            return False
+        job.set_status(RUNNING)
+        if job.job_id not in self._tasks:
+            self._spawn(job)
+        return True
+
+    def pause(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status != RUNNING:
+            return False
+        job.set_status(PAUSED)
+        return True
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status in (DONE, CANCELLED):
+            return False
+        job.set_status(CANCELLED)
+        return True
+
+    def describe(self):
+        """Returns a short text listing of the jobs that are not finished."""
+
+        lines = []
+        for job in self.jobs.values():
+            if job.status in (RUNNING, PAUSED):
+                preview = job.meta['text'][:30]
+                lines.append(f"{job.job_id} [{job.status}] {preview}")
+        return "\n".join(lines)
+
+    def active(self):
+        """Returns the number of jobs currently sending."""
+
+        return len(self._tasks)
+
+    def _spawn(self, job):
+        self._tasks[job.job_id] = asyncio.ensure_future(self._run(job))
+
+    async def _run(self, job):
+        async def on_outcome(user_id, outcome):
+            job.record(user_id, outcome)
+
+        try:
+            # Loop in case the job was paused and resumed while stopping
+            while job.status == RUNNING:
+                job.checkpoint()
+                user_ids = job.pending_recipients()
+                if not user_ids:
+                    job.set_status(DONE)
+                    break
+                await self.broadcaster.run(
+                    user_ids, job.meta['text'],
+                    report_chat_id=job.meta['report_chat_id'],
+                    on_outcome=on_outcome,
+                    should_stop=lambda: job.status != RUNNING)
+        finally:
+            job.close()
+            self._tasks.pop(job.job_id, None)
+
+    async def close(self):
+        """Stops running jobs, keeping them resumable on the next start."""
+
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
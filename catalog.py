@@ -0,0 +1,231 @@
+import asyncio
+import csv
+import os
+from types import MappingProxyType
+
+from metrics import metrics
+
+TIMEFRAMES = ['day', 'week', 'month']
+FIELDNAMES = ['coin', 'day_price', 'day_image',
+              'week_price', 'week_image', 'month_price', 'month_image',
+              'day_stop', 'day_take', 'week_stop', 'week_take',
+              'month_stop', 'month_take']
+
+# Stop-loss and take-profit percentages used when the CSV has none
+DEFAULT_STOP_TAKE = {
+    "day": (1.3, 4),
+    "week": (3, 10),
+    "month": (14, 44),
+}
+
+
+def read_data(csv_file, history=None):
+    """Reads data from a CSV file.
+
+    With a PriceHistory that was last written together with the CSV as it
+    is now, the catalog comes from the last row of each history series
+    and the CSV is not parsed.
+    """
+
+    if history is not None and history.matches(csv_file):
+        crypto_data = history.latest()
+        if crypto_data is not None:
+            return crypto_data
+
+    crypto_data = {}
+    with open(csv_file, 'r', newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            coin = row['coin']
+            crypto_data[coin] = {}
+            for timeframe in TIMEFRAMES:
+                stop, take = DEFAULT_STOP_TAKE[timeframe]
+                crypto_data[coin][timeframe] = {
+                    'price': float(row[f'{timeframe}_price']),
+                    'image': row[f'{timeframe}_image'],
+                    # Stop/take columns are optional
+                    'stop': float(row.get(f'{timeframe}_stop') or stop),
+                    'take': float(row.get(f'{timeframe}_take') or take),
+                }
+    return crypto_data
+
+
+def write_data(csv_file, crypto_data):
+    """Writes data to a CSV file via a temp file and rename."""
+
+    tmp_filename = f"{csv_file}.tmp"
+    with open(tmp_filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for coin, data in crypto_data.items():
+            row = {'coin': coin}
+            for timeframe in TIMEFRAMES:
+                for field in ['price', 'image', 'stop', 'take']:
+                    row[f'{timeframe}_{field}'] = data[timeframe][field]
+            writer.writerow(row)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(tmp_filename, csv_file)
+
+
+def _freeze(crypto_data):
+    return MappingProxyType({
+        coin: MappingProxyType({
+            timeframe: MappingProxyType(dict(entry))
+            for timeframe, entry in timeframes.items()
+        })
+        for coin, timeframes in crypto_data.items()
+    })
+
+
+def _thaw(snapshot):
+    return {
+        coin: {timeframe: dict(entry) for timeframe, entry in timeframes.items()}
+        for coin, timeframes in snapshot.items()
+    }
+
+
+class CatalogSnapshot:
+    """An immutable, versioned view of the coin catalog."""
+
+    def __init__(self, version, crypto_data):
+        self.version = version
+        self.data = _freeze(crypto_data)
+
+
+class CatalogEdit:
+    """Changes staged against the catalog, applied together on commit."""
+
+    def __init__(self):
+        self.changes = []
+
+    def set(self, coin, timeframe, **fields):
+        """Stages new values (price, image) for a coin and timeframe."""
+
+        self.changes.append((coin, timeframe, fields))
+        return self
+
+
+class CatalogStore:
+    """Holds the current catalog snapshot and reloads it when the CSV changes.
+
+    Readers use `store.data` (or `store.snapshot`) without locking: a commit
+    or reload builds a new snapshot and swaps the reference in one step.
+    With a `history` (PriceHistory), every version of the catalog written
+    or reloaded is also appended to it.
+    """
+
+    def __init__(self, csv_file, watch_interval=2.0, history=None):
+        self.csv_file = csv_file
+        self.watch_interval = watch_interval
+        self.history = history
+        self.snapshot = CatalogSnapshot(0, {})
+        self.listeners = []
+        self._file_signature = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def data(self):
+        return self.snapshot.data
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.csv_file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _publish(self, crypto_data):
+        self.snapshot = CatalogSnapshot(self.snapshot.version + 1, crypto_data)
+        for listener in self.listeners:
+            listener(self.snapshot)
+
+    def _record(self, crypto_data):
+        if self.history is None:
+            return
+        try:
+            self.history.record(crypto_data, self.csv_file)
+        except OSError as e:
+            print(f"Error writing price history: {str(e)}")
+
+    def _write(self, crypto_data):
+        write_data(self.csv_file, crypto_data)
+        self._record(crypto_data)
+
+    def _read(self):
+        crypto_data = read_data(self.csv_file)
+        self._record(crypto_data)
+        return crypto_data
+
+    def load(self):
+        """Reads the catalog synchronously, used at startup."""
+
+        self._file_signature = self._signature()
+        crypto_data = read_data(self.csv_file, self.history)
+        # Seeds the history, or catches up with a CSV edited while the bot was stopped
+        self._record(crypto_data)
+        self._publish(crypto_data)
+        return self
+
+    def begin(self):
+        """Starts a set of staged changes."""
+
+        return CatalogEdit()
+
+    async def commit(self, edit):
+        """Applies staged changes, writes the CSV and publishes a new snapshot."""
+
+        async with self._lock:
+            crypto_data = _thaw(self.snapshot.data)
+            for coin, timeframe, fields in edit.changes:
+                crypto_data[coin][timeframe].update(fields)
+            loop = asyncio.get_event_loop()
+            with metrics.timer('disk_io_seconds', op='catalog_write'):
+                await loop.run_in_executor(None, self._write, crypto_data)
+            self._file_signature = self._signature()
+            self._publish(crypto_data)
+        return self.snapshot
+
+    async def reload_if_changed(self):
+        """Reloads the catalog if the CSV was changed outside the bot."""
+
+        signature = self._signature()
+        if signature is None or signature == self._file_signature:
+            return False
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op='catalog_reload'):
+                    crypto_data = await loop.run_in_executor(None, self._read)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error reloading {self.csv_file}: {str(e)}")
+                return False
+            self._file_signature = signature
+            self._publish(crypto_data)
+        print(f"Reloaded {self.csv_file}, catalog version {self.version}")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            await self.reload_if_changed()
+
+    def start(self):
+        """Starts watching the CSV file for external changes."""
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
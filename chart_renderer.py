@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import metrics
+
+# Bump when the drawing code changes so old renders are not reused
+RENDER_VERSION = 1
+
+
+def render_chart(filename, coin, timeframe, candles, levels):
+    """Draws closing prices with the entry, stop and take levels into a PNG.
+
+    Runs in a worker process. matplotlib is imported here so the bot
+    process itself never pays for it.
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+    entry = levels['price']
+    stop = entry * (1 - levels['stop'] / 100)
+    take = entry * (1 + levels['take'] / 100)
+
+    figure, axes = pyplot.subplots(figsize=(8, 4.5), dpi=100)
+    try:
+        times = candles[:, 0].astype('datetime64[s]')
+        axes.plot(times, candles[:, 4], color='#1f77b4', linewidth=1.2)
+        for value, color, label in [(take, '#2ca02c', 'Take'),
+                                    (entry, '#ff7f0e', 'Entry'),
+                                    (stop, '#d62728', 'Stop')]:
+            axes.axhline(value, color=color, linestyle='--', linewidth=1)
+            axes.annotate(f"{label} {value:.6g}", xy=(1, value),
+                          xycoords=('axes fraction', 'data'), xytext=(-4, 3),
+                          textcoords='offset points', ha='right', color=color)
+        axes.set_title(f"{coin} ({timeframe})")
+        axes.grid(alpha=0.3)
+        figure.autofmt_xdate()
+        figure.tight_layout()
+        tmp_filename = f"{filename}.tmp"
+        figure.savefig(tmp_filename, format='png')
+        os.replace(tmp_filename, filename)
+    finally:
+        pyplot.close(figure)
+    return filename
+
+
+def render_key(coin, timeframe, last_timestamp, levels):
+    """Content address of a render: the chart depends on nothing else."""
+
+    text = (f"{RENDER_VERSION}|{coin}|{timeframe}|{last_timestamp!r}|"
+            f"{levels['price']!r}|{levels['stop']!r}|{levels['take']!r}")
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class ChartRenderer:
+    """Renders chart PNGs in a process pool and caches them on disk.
+
+    Renders are stored as `<key>.png` in `cache_dir`, where the key hashes
+    the data the chart was drawn from, so a changed price or new candle
+    gives a new file. The least recently used renders are deleted once the
+    cache holds more than `max_entries`. Concurrent requests for the same
+    render share one job.
+    """
+
+    def __init__(self, cache_dir, max_entries=500, workers=2):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.workers = workers
+        self.entries = collections.OrderedDict()
+        self._pending = {}
+        self._executor = None
+
+    def load(self):
+        """Indexes renders left by a previous run, oldest use first."""
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        renders = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)  # Left by an interrupted render
+            elif name.endswith('.png'):
+                renders.append((os.path.getmtime(path), name[:-len('.png')]))
+        self.entries = collections.OrderedDict(
+            (key, os.path.join(self.cache_dir, f"{key}.png")) for _, key in sorted(renders))
+        return self
+
+    def _touch(self, key):
+        self.entries.move_to_end(key)
+        try:
+            os.utime(self.entries[key])  # Keeps the LRU order across restarts
+        except OSError:
+            pass
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            _, path = self.entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def chart(self, coin, timeframe, last_timestamp, candles, levels):
+        """Returns the path of a rendered chart, rendering it if needed.
+
+        Returns None if rendering fails.
+        """
+
+        key = render_key(coin, timeframe, last_timestamp, levels)
+        if key in self.entries:
+            metrics.inc('chart_renders_total', result='hit')
+            self._touch(key)
+            return self.entries[key]
+
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(
+                self._render(key, coin, timeframe, candles, levels))
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        metrics.inc('chart_renders_total', result='miss')
+        return await asyncio.shield(future)
+
+    async def _render(self, key, coin, timeframe, candles, levels):
+        if self._executor is None:
+            # Not fork: the bot has threads running (executors, SQLite), and a
+            # forked child can deadlock on a lock one of them held. Workers come
+            # from a single-threaded fork server instead.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+        path = os.path.join(self.cache_dir, f"{key}.png")
+        loop = asyncio.get_event_loop()
+        try:
+            with metrics.timer('chart_render_seconds'):
+                await loop.run_in_executor(self._executor, render_chart, path,
+                                           coin, timeframe, candles, dict(levels))
+        except Exception as e:
+            print(f"Error rendering chart for {coin} ({timeframe}): {str(e)}")
+            return None
+        self.entries[key] = path
+        self._evict()
+        return path
+
+    def close(self):
+        """Shuts down the render processes."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
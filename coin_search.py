@@ -0,0 +1,97 @@
+import collections
+import re
+
+# Tickers of well-known coins, searched alongside the catalog names
+TICKERS = {
+    'Bitcoin': 'BTC',
+    'Ethereum': 'ETH',
+    'Tether': 'USDT',
+    'BNB': 'BNB',
+    'Solana': 'SOL',
+    'XRP': 'XRP',
+    'Cardano': 'ADA',
+    'Dogecoin': 'DOGE',
+    'Toncoin': 'TON',
+    'Polkadot': 'DOT',
+    'Polygon': 'MATIC',
+    'Litecoin': 'LTC',
+    'Tron': 'TRX',
+    'Avalanche': 'AVAX',
+    'Chainlink': 'LINK',
+    'Shiba Inu': 'SHIB',
+    'Uniswap': 'UNI',
+    'Stellar': 'XLM',
+    'Monero': 'XMR',
+    'Cosmos': 'ATOM',
+}
+
+_WORD = re.compile(r'\w+')
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class CoinIndex:
+    """Prefix and trigram indexes over coin names and tickers.
+
+    Every word of a name and the ticker are indexed by all their prefixes,
+    so a prefix query is one dict lookup. Queries that are not a prefix of
+    any word fall back to the trigram index, which narrows the candidates
+    to coins containing every trigram of the query before checking them.
+    Rebuilt from each catalog snapshot.
+    """
+
+    def __init__(self, tickers=TICKERS):
+        self.tickers = tickers
+        self.coins = []
+        self.prefixes = {}
+        self.trigrams = {}
+
+    def rebuild(self, snapshot):
+        """Indexes the coins of a catalog snapshot."""
+
+        prefixes = collections.defaultdict(set)
+        trigrams = collections.defaultdict(set)
+        for coin in snapshot.data:
+            words = _WORD.findall(coin.lower())
+            ticker = self.tickers.get(coin)
+            if ticker:
+                words.append(ticker.lower())
+            for word in words:
+                for length in range(1, len(word) + 1):
+                    prefixes[word[:length]].add(coin)
+            for trigram in _trigrams(coin.lower()):
+                trigrams[trigram].add(coin)
+        self.coins = list(snapshot.data)
+        self.prefixes = dict(prefixes)
+        self.trigrams = dict(trigrams)
+
+    def _rank(self, coin, query):
+        ticker = (self.tickers.get(coin) or '').lower()
+        name = coin.lower()
+        if query in (name, ticker):
+            return 0
+        if name.startswith(query) or ticker.startswith(query):
+            return 1
+        return 2
+
+    def search(self, query):
+        """Returns the coins matching `query`, best matches first.
+
+        An empty query returns every coin in catalog order.
+        """
+
+        query = query.strip().lower()
+        if not query:
+            return list(self.coins)
+        matches = self.prefixes.get(query)
+        if matches is None and len(query) >= 3:
+            candidates = None
+            for trigram in _trigrams(query):
+                coins = self.trigrams.get(trigram, set())
+                candidates = coins if candidates is None else candidates & coins
+                if not candidates:
+                    break
+            matches = {coin for coin in candidates or () if query in coin.lower()}
+        return sorted(matches or (), key=lambda coin: (self._rank(coin, query), coin))
@@ -1,8 +1,184 @@
 # config.py
 import json
+import os
+import re
 
-with open('config.json', 'r') as config_file:
-    config = json.load(config_file)
+# Any key can be overridden by an environment variable named BOT_<KEY>.
+# Values of string settings are used as they are. Other values are parsed
+# as JSON, so BOT_ADMIN_USER_IDS='[1, 2]' and BOT_WEBAPP_PORT=8443 work.
+ENV_PREFIX = 'BOT_'
+CONFIG_FILE = os.environ.get(f"{ENV_PREFIX}CONFIG_FILE", 'config.json')
+
+REQUIRED = object()
+
+# Key: (default, type); settings whose default is None also accept null
+SETTINGS = {
+    'API_TOKEN': (REQUIRED, str),
+    'ADMIN_PASSWORD': (REQUIRED, str),
+    'CSV_FILE': (REQUIRED, str),
+    'IMAGE_DIR': (REQUIRED, str),
+    'USER_STATS_FILE': (REQUIRED, str),
+    'USER_IDS_FILE': (REQUIRED, str),
+    'ADMIN_USER_IDS': (REQUIRED, list),
+    'MEDIA_CACHE_FILE': ('media_cache.json', str),
+    'FSM_STORAGE_FILE': ('fsm.sqlite3', str),
+    'REQUEST_LOG_FILE': ('request_log.csv', str),
+    'BROADCASTS_DIR': ('broadcasts', str),
+    # Webhook mode is used when WEBHOOK_URL is set, long polling otherwise
+    'WEBHOOK_URL': (None, str),
+    'WEBHOOK_PATH': ('/webhook', str),
+    'WEBAPP_HOST': ('0.0.0.0', str),
+    'WEBAPP_PORT': (8080, int),
+    'WEBHOOK_WORKERS': (8, int),
+    'WEBHOOK_QUEUE_SIZE': (1000, int),
+    # Base URL of the Bot API server, e.g. a local server for benchmarks
+    'TELEGRAM_API_URL': (None, str),
+    # Port of the Prometheus /metrics endpoint, disabled when not set
+    'METRICS_PORT': (None, int),
+    # Per-coin OHLCV files (<coin>.csv) the analysis engine computes levels from
+    'HISTORY_DIR': ('history', str),
+    'ANALYSIS_INTERVAL': (60, int),  # seconds
+    # Rendered chart PNGs, least recently used ones are deleted past the limit
+    'CHART_CACHE_DIR': ('charts', str),
+    'CHART_CACHE_SIZE': (500, int),
+    # Price alerts; ticks are "coin,price" lines from a file and/or a local TCP port
+    'ALERTS_FILE': ('alerts.json', str),
+    'PRICE_FEED_FILE': (None, str),
+    'PRICE_FEED_PORT': (None, int),
+    # Last seen, language, coin interests and delivery failures per user
+    'USER_META_FILE': ('user_meta.jsonl', str),
+    # Recommendations sent to users, replayed against HISTORY_DIR by /backtest
+    'RECOMMENDATIONS_DIR': ('recommendations', str),
+    # Every catalog version, as fixed-width column files per coin and timeframe
+    'PRICE_HISTORY_DIR': ('price_history', str),
+    # More bots hosted by the same process, see PER_BOT_KEYS
+    'BOTS': ([], list),
+}
+
+# Keys a bot in BOTS can set; the others are shared by all hosted bots.
+# Each entry needs a NAME and an API_TOKEN, and keeps its data files in a
+# directory named after it unless it sets their paths.
+PER_BOT_KEYS = ['API_TOKEN', 'ADMIN_PASSWORD', 'ADMIN_USER_IDS', 'USER_STATS_FILE',
+                'USER_IDS_FILE', 'MEDIA_CACHE_FILE', 'FSM_STORAGE_FILE', 'REQUEST_LOG_FILE',
+                'BROADCASTS_DIR', 'ALERTS_FILE', 'USER_META_FILE']
+PER_BOT_DATA_KEYS = PER_BOT_KEYS[3:]
+# Name of the bot configured by the top-level keys
+MAIN_BOT_NAME = 'main'
+
+POSITIVE_INTS = ['WEBAPP_PORT', 'WEBHOOK_WORKERS', 'WEBHOOK_QUEUE_SIZE', 'METRICS_PORT',
+                 'ANALYSIS_INTERVAL', 'CHART_CACHE_SIZE', 'PRICE_FEED_PORT']
+
+
+class ConfigError(Exception):
+    """Raised when the configuration is missing keys or has invalid values."""
+
+
+def _parse_env(value, kind):
+    if kind is str:
+        return value  # BOT_ADMIN_PASSWORD=1e3 stays '1e3', not '1000.0'
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _check_bot(entry):
+    """Returns the problems of one BOTS entry."""
+
+    if not isinstance(entry, dict):
+        return [f"BOTS entries must be objects, got {entry!r}"]
+    errors = []
+    name = entry.get('NAME')
+    if not isinstance(name, str) or not re.fullmatch(r'[\w-]+', name):
+        errors.append(f"BOTS entry {name!r} needs a NAME of letters, digits, _ and -")
+    if not re.fullmatch(r'\d+:[\w-]+', str(entry.get('API_TOKEN', ''))):
+        errors.append(f"BOTS entry {name!r} needs a valid API_TOKEN")
+    for key, value in entry.items():
+        if key in ('NAME', 'API_TOKEN'):
+            continue
+        if key not in PER_BOT_KEYS:
+            errors.append(f"BOTS entry {name!r} cannot set {key}")
+        elif not isinstance(value, SETTINGS[key][1]):
+            errors.append(f"BOTS entry {name!r}: {key} must be of type "
+                          f"{SETTINGS[key][1].__name__}, got {value!r}")
+    return errors
+
+
+def load_config(filename=CONFIG_FILE, environ=os.environ):
+    """Reads the config file, applies environment overrides and validates the result.
+
+    The file may be missing if every required key comes from the
+    environment. Raises ConfigError listing every problem found.
+    """
+
+    try:
+        with open(filename, 'r') as config_file:
+            values = json.load(config_file)
+    except FileNotFoundError:
+        values = {}
+    except ValueError as e:
+        raise ConfigError(f"{filename} is not valid JSON: {str(e)}")
+
+    for key in SETTINGS:
+        if f"{ENV_PREFIX}{key}" in environ:
+            values[key] = _parse_env(environ[f"{ENV_PREFIX}{key}"], SETTINGS[key][1])
+
+    settings = {}
+    errors = []
+    for key, (default, kind) in SETTINGS.items():
+        value = values.get(key, default)
+        if value is REQUIRED:
+            errors.append(f"{key} is required")
+            continue
+        if value is None and default is None:
+            settings[key] = value
+            continue
+        if not isinstance(value, kind) or isinstance(value, bool):
+            errors.append(f"{key} must be of type {kind.__name__}, got {value!r}")
+            continue
+        settings[key] = value
+
+    if 'API_TOKEN' in settings and not re.fullmatch(r'\d+:[\w-]+', settings['API_TOKEN']):
+        errors.append("API_TOKEN does not look like a bot token")
+    if 'ADMIN_USER_IDS' in settings and not all(
+            isinstance(user_id, int) for user_id in settings['ADMIN_USER_IDS']):
+        errors.append("ADMIN_USER_IDS must be a list of numeric user IDs")
+    for key in POSITIVE_INTS:
+        if isinstance(settings.get(key), int) and settings[key] <= 0:
+            errors.append(f"{key} must be positive")
+    for entry in settings.get('BOTS') or []:
+        errors.extend(_check_bot(entry))
+    if not errors and settings.get('BOTS'):
+        names = [MAIN_BOT_NAME] + [entry['NAME'] for entry in settings['BOTS']]
+        tokens = [settings.get('API_TOKEN')] + [entry['API_TOKEN'] for entry in settings['BOTS']]
+        if len(set(names)) < len(names):
+            errors.append(f"BOTS names must be unique and not {MAIN_BOT_NAME!r}")
+        if len(set(tokens)) < len(tokens):
+            errors.append("Every hosted bot needs its own API_TOKEN")
+    unknown = sorted(set(values) - set(SETTINGS))
+    if unknown:
+        print(f"Ignoring unknown config keys: {', '.join(unknown)}")
+
+    if errors:
+        raise ConfigError(f"Invalid configuration in {filename}:\n" + "\n".join(errors))
+    return settings
+
+
+def hosted_bots(settings):
+    """Returns the settings of every bot to host, the main bot first."""
+
+    main_bot = {key: settings[key] for key in PER_BOT_KEYS}
+    bots = [dict(main_bot, NAME=MAIN_BOT_NAME)]
+    for entry in settings['BOTS']:
+        bot = dict(main_bot)
+        for key in PER_BOT_DATA_KEYS:
+            bot[key] = os.path.join(entry['NAME'], settings[key])
+        bot.update(entry)
+        bots.append(bot)
+    return bots
+
+
+config = load_config()
 
 API_TOKEN = config['API_TOKEN']
 ADMIN_PASSWORD = config['ADMIN_PASSWORD']
@@ -11,3 +187,26 @@ IMAGE_DIR = config['IMAGE_DIR']
 USER_STATS_FILE = config['USER_STATS_FILE']
 USER_IDS_FILE = config['USER_IDS_FILE']
 ADMIN_USER_IDS = config['ADMIN_USER_IDS']
+MEDIA_CACHE_FILE = config['MEDIA_CACHE_FILE']
+FSM_STORAGE_FILE = config['FSM_STORAGE_FILE']
+REQUEST_LOG_FILE = config['REQUEST_LOG_FILE']
+BROADCASTS_DIR = config['BROADCASTS_DIR']
+WEBHOOK_URL = config['WEBHOOK_URL']
+WEBHOOK_PATH = config['WEBHOOK_PATH']
+WEBAPP_HOST = config['WEBAPP_HOST']
+WEBAPP_PORT = config['WEBAPP_PORT']
+WEBHOOK_WORKERS = config['WEBHOOK_WORKERS']
+WEBHOOK_QUEUE_SIZE = config['WEBHOOK_QUEUE_SIZE']
+TELEGRAM_API_URL = config['TELEGRAM_API_URL']
+METRICS_PORT = config['METRICS_PORT']
+HISTORY_DIR = config['HISTORY_DIR']
+ANALYSIS_INTERVAL = config['ANALYSIS_INTERVAL']
+CHART_CACHE_DIR = config['CHART_CACHE_DIR']
+CHART_CACHE_SIZE = config['CHART_CACHE_SIZE']
+ALERTS_FILE = config['ALERTS_FILE']
+PRICE_FEED_FILE = config['PRICE_FEED_FILE']
+PRICE_FEED_PORT = config['PRICE_FEED_PORT']
+USER_META_FILE = config['USER_META_FILE']
+RECOMMENDATIONS_DIR = config['RECOMMENDATIONS_DIR']
+PRICE_HISTORY_DIR = config['PRICE_HISTORY_DIR']
+HOSTED_BOTS = hosted_bots(config)
@@ -0,0 +1,208 @@
+import asyncio
+import copy
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from metrics import metrics
+
+
+class SQLiteStorage(BaseStorage):
+    """Durable FSM storage in a local SQLite database in WAL mode.
+
+    Reads and writes go through an in-memory cache. Changed records are
+    written to the database in one transaction every `flush_interval`
+    seconds. Conversations idle for longer than `ttl` seconds are deleted.
+    Clean records idle for `cache_ttl` seconds are evicted from memory.
+    All database access happens on a single worker thread.
+    """
+
+    def __init__(self, path, flush_interval=1.0, ttl=7 * 24 * 60 * 60,
+                 cache_ttl=10 * 60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._dirty = set()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn = None
+        self._task = None
+        self._closed = False
+        self._last_expiry = 0.0
+
+    # Database access, always called on the worker thread
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                " chat TEXT NOT NULL, user TEXT NOT NULL,"
+                " state TEXT, data TEXT, bucket TEXT, updated REAL NOT NULL,"
+                " PRIMARY KEY (chat, user))")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated)")
+            self._conn.commit()
+        return self._conn
+
+    def _db_load(self, chat, user):
+        row = self._connect().execute(
+            "SELECT state, data, bucket, updated FROM fsm WHERE chat = ? AND user = ?",
+            (chat, user)).fetchone()
+        if row is None or row[3] < time.time() - self.ttl:
+            return None
+        return {
+            'state': row[0],
+            'data': json.loads(row[1]) if row[1] else {},
+            'bucket': json.loads(row[2]) if row[2] else {},
+            'updated': row[3],
+        }
+
+    def _db_write(self, records, expire_before):
+        conn = self._connect()
+        with conn:
+            for (chat, user), record in records:
+                if record['state'] is None and not record['data'] and not record['bucket']:
+                    conn.execute("DELETE FROM fsm WHERE chat = ? AND user = ?",
+                                 (chat, user))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket, updated)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (chat, user, record['state'], json.dumps(record['data']),
+                         json.dumps(record['bucket']), record['updated']))
+            if expire_before is not None:
+                conn.execute("DELETE FROM fsm WHERE updated < ?", (expire_before,))
+
+    def _db_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # Cache management
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        with metrics.timer('fsm_storage_seconds', op=func.__name__.lstrip('_')):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _ensure_started(self):
+        if self._task is None and not self._closed:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def _record(self, chat, user):
+        self._ensure_started()
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        record = self._cache.get(key)
+        if record is None:
+            record = await self._run(self._db_load, chat, user)
+            # Another coroutine may have filled the cache while we waited
+            record = self._cache.get(key) or record or {
+                'state': None, 'data': {}, 'bucket': {}, 'updated': time.time()}
+            self._cache[key] = record
+        record['touched'] = time.monotonic()
+        return key, record
+
+    def _changed(self, key, record):
+        record['updated'] = time.time()
+        self._dirty.add(key)
+
+    async def flush(self):
+        """Writes changed records to the database and expires idle ones."""
+
+        expire_before = None
+        if time.monotonic() - self._last_expiry > 60:
+            self._last_expiry = time.monotonic()
+            expire_before = time.time() - self.ttl
+        if not self._dirty and expire_before is None:
+            return
+        dirty, self._dirty = self._dirty, set()
+        records = [(key, copy.deepcopy(self._cache[key]))
+                   for key in dirty if key in self._cache]
+        try:
+            await self._run(self._db_write, records, expire_before)
+        except sqlite3.Error as e:
+            self._dirty |= dirty  # Retry on the next flush
+            print(f"Error writing FSM storage: {str(e)}")
+            return
+        self._evict_idle()
+
+    def _evict_idle(self):
+        idle_before = time.monotonic() - self.cache_ttl
+        for key in [key for key, record in self._cache.items()
+                    if record['touched'] < idle_before and key not in self._dirty]:
+            del self._cache[key]
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # BaseStorage interface
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self._run(self._db_close)
+
+    async def wait_closed(self):
+        self._executor.shutdown(wait=True)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        state = record['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._changed(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._record(chat, user)
+        record['data'] = copy.deepcopy(data) if data else {}
+        self._changed(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        if data is None:
+            data = {}
+        key, record = await self._record(chat, user)
+        record['data'].update(data, **kwargs)
+        self._changed(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket) if bucket else {}
+        self._changed(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        if bucket is None:
+            bucket = {}
+        key, record = await self._record(chat, user)
+        record['bucket'].update(bucket, **kwargs)
+        self._changed(key, record)
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import signal
+
+import aiohttp
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from metrics import InstrumentedBot
+
+
+class SessionPool:
+    """One aiohttp session, and so one connection pool, for every hosted bot."""
+
+    def __init__(self, limit=100):
+        self.limit = limit
+        self._session = None
+
+    def get(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit), json_serialize=json.dumps)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class SharedSessionBot(InstrumentedBot):
+    """Bot that sends its API calls through a session shared with other bots."""
+
+    def __init__(self, token, session_pool, **kwargs):
+        super().__init__(token=token, **kwargs)
+        self.session_pool = session_pool
+
+    async def get_new_session(self):
+        return self.session_pool.get()
+
+    async def close(self):
+        """Leaves the shared session open, SessionPool.close() closes it."""
+
+
+def run_polling(dispatchers, on_startup, on_shutdown):
+    """Long-polls every dispatcher from one event loop until SIGINT or SIGTERM.
+
+    `on_startup` and `on_shutdown` are called once with the list of
+    dispatchers. Updates sent while the bots were offline are skipped.
+    """
+
+    async def run():
+        await on_startup(dispatchers)
+        try:
+            for dp in dispatchers:
+                await dp.skip_updates()
+            await asyncio.gather(*[dp.start_polling() for dp in dispatchers])
+        finally:
+            for dp in dispatchers:
+                dp.stop_polling()
+            await on_shutdown(dispatchers)
+
+    # The loop aiogram bound the bots and dispatchers to at import time, as executor does
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(run())
+    # Ctrl+C, systemd and docker stop all let the finally block of run() shut down
+    loop.add_signal_handler(signal.SIGINT, task.cancel)
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+        loop.remove_signal_handler(signal.SIGTERM)
+
+
+class BotAppMiddleware(BaseMiddleware):
+    """Gives handlers the BotApp of the bot that received the update, as `app`."""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    async def on_pre_process_message(self, message, data):
+        data['app'] = self.app
+
+    async def on_pre_process_callback_query(self, callback_query, data):
+        data['app'] = self.app
+
+    async def on_pre_process_inline_query(self, inline_query, data):
+        data['app'] = self.app
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import tempfile
+
+from metrics import metrics
+
+# Telegram's getFile only serves files of up to 20 MB
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Longest side of a stored chart image, in pixels
+MAX_IMAGE_SIDE = 1600
+ACCEPTED_FORMATS = {'PNG', 'JPEG'}
+
+
+class ImageRejected(Exception):
+    """Raised when an upload is not a usable PNG or JPEG image."""
+
+
+async def download_to_file(bot, file_path, destination, max_bytes=MAX_DOWNLOAD_BYTES):
+    """Streams a Telegram file to `destination` chunk by chunk.
+
+    Chunks are written from executor threads, so neither the download nor
+    the disk writes hold up the event loop, and memory use stays at one
+    chunk. Returns the number of bytes written.
+    """
+
+    loop = asyncio.get_event_loop()
+    session = await bot.get_session()
+    file = await loop.run_in_executor(None, open, destination, 'wb')
+    size = 0
+    try:
+        async with session.get(bot.get_file_url(file_path), proxy=bot.proxy,
+                               proxy_auth=bot.proxy_auth, raise_for_status=True) as response:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageRejected(f"the file is larger than {max_bytes // (1024 * 1024)} MB")
+                await loop.run_in_executor(None, file.write, chunk)
+    finally:
+        await loop.run_in_executor(None, file.close)
+    return size
+
+
+def normalize_image(source, destination, max_side=MAX_IMAGE_SIDE):
+    """Validates an uploaded image and stores it as a recompressed PNG.
+
+    The image is checked to be a complete PNG or JPEG, rotated according
+    to its EXIF orientation, downsized to at most `max_side` pixels and
+    written to a temp file that replaces `destination` in one rename, so
+    readers never see a partial image. Runs in a worker thread.
+    """
+
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(source) as image:
+            if image.format not in ACCEPTED_FORMATS:
+                raise ImageRejected(f"unsupported image format {image.format}")
+            image.verify()
+        # verify() leaves the image unusable, so it is opened again to decode it
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image.thumbnail((max_side, max_side))
+            tmp_filename = f"{destination}.tmp"
+            image.save(tmp_filename, format='PNG')
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        if os.path.exists(f"{destination}.tmp"):
+            os.remove(f"{destination}.tmp")
+        raise ImageRejected(f"the image could not be read ({str(e)})")
+    os.replace(tmp_filename, destination)
+    return image.size
+
+
+async def ingest_image(bot, file_id, destination):
+    """Downloads a Telegram photo, normalises it and swaps it in at `destination`.
+
+    Raises ImageRejected if the upload is not a usable image.
+    """
+
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    # The download lands next to the destination so the final rename stays on one filesystem
+    fd, download_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    os.close(fd)
+    loop = asyncio.get_event_loop()
+    try:
+        file_info = await bot.get_file(file_id)
+        with metrics.timer('disk_io_seconds', op='image_download'):
+            await download_to_file(bot, file_info.file_path, download_path)
+        with metrics.timer('disk_io_seconds', op='image_normalize'):
+            return await loop.run_in_executor(None, normalize_image, download_path, destination)
+    finally:
+        try:
+            os.remove(download_path)
+        except OSError:
+            pass
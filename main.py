@@ -1,49 +1,54 @@
-import csv
-from aiogram import Bot, Dispatcher, types
+import time
+STARTED = time.perf_counter()  # Taken before the other imports for the startup report
+
+from aiogram import Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram import executor
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.utils import exceptions
+from aiogram.utils.parts import safe_split_text
 import os
-import datetime
-import json
-
-# Load configuration from JSON file
-with open('config.json', 'r') as config_file:
-    config = json.load(config_file)
-
-# Access configuration values
-API_TOKEN = config['API_TOKEN']
-ADMIN_PASSWORD = config['ADMIN_PASSWORD']
-CSV_FILE = config['CSV_FILE']
-IMAGE_DIR = config['IMAGE_DIR']
-USER_STATS_FILE = config['USER_STATS_FILE']
-USER_IDS_FILE = config['USER_IDS_FILE']
-ADMIN_USER_IDS = config['ADMIN_USER_IDS']
-print(ADMIN_USER_IDS)
-
-# Initialize bot and dispatcher
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
-dp.middleware.setup(LoggingMiddleware())
-
-
-# Define fieldnames for the user statistics CSV file
-USER_STATS_FIELDNAMES = ['day', 'week', 'month', 'total',
-                         'last_update_week']
-USER_IDS_FILE = 'user_ids.txt'
+import asyncio
+import aiohttp
+
+from config import (
+    CSV_FILE, IMAGE_DIR, HOSTED_BOTS, MAIN_BOT_NAME, PER_BOT_DATA_KEYS,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE,
+    TELEGRAM_API_URL, METRICS_PORT, HISTORY_DIR, ANALYSIS_INTERVAL, CHART_CACHE_DIR,
+    CHART_CACHE_SIZE, PRICE_FEED_FILE, PRICE_FEED_PORT, RECOMMENDATIONS_DIR, PRICE_HISTORY_DIR,
+)
+from user_registry import UserRegistry
+from stats_sink import StatsSink
+from broadcast import Broadcaster
+from broadcast_jobs import BroadcastJobManager
+from media_cache import MediaCache
+from fsm_storage import SQLiteStorage
+from request_log import RequestLog
+from catalog import CatalogStore, TIMEFRAMES
+from coin_search import CoinIndex
+from render_cache import RenderCache
+from chart_renderer import ChartRenderer
+from alerts import AlertManager
+from price_feed import FilePriceFeed, SocketPriceFeed
+from throttling import ThrottlingMiddleware
+from image_ingest import ImageRejected, ingest_image
+from user_meta import UserMetaStore, UserMetaMiddleware
+from recommendations import RecommendationLog
+from price_history import PriceHistory, format_price_history
+from startup import StartupTimer, ReadinessMiddleware
+from hosting import SessionPool, SharedSessionBot, BotAppMiddleware, run_polling
+from metrics import metrics, InstrumentationMiddleware, format_perf, start_metrics_server
+
+startup = StartupTimer(STARTED)
+startup.mark('imports and config')
+
+api_server = TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+# Every hosted bot sends its API calls through the same connection pool
+session_pool = SessionPool()
 
 
 # States
-request_count_24h = 0
-request_count_7d = 0
-request_count_30d = 0
-total_request_count = 0
-
-
 class Form(StatesGroup):
     role = State()
     password = State()
@@ -56,268 +61,394 @@ class Form(StatesGroup):
     send_message_to_all = State()
 
 
-def store_user_ids(user_ids, filename):
-    """Stores user IDs in a text file."""
-
-    with open(filename, 'w') as file:
-        for user_id in user_ids:
-            file.write(f"{user_id}\n")
+USER_IDS_COMPACT_INTERVAL = 10 * 60  # seconds
 
 
-def read_user_ids(filename):
-    """Reads user IDs from a text file."""
-
-    user_ids = []
-    try:
-        with open(filename, 'r') as file:
-            for line in file:
-                user_ids.append(int(line.strip()))
-    except FileNotFoundError:
-        pass  # If the file doesn't exist, return an empty list
-    return user_ids
-
+class BotApp:
+    """One hosted bot: its Telegram client, dispatcher and per-bot state.
 
-# def count_requests_last_24_hours():
-#     """Counts user requests in the last 24 hours."""
+    Admins, users, statistics, file_ids, broadcasts and alerts belong to
+    a bot; the catalog, analysis, charts and keyboards are shared by all
+    bots of the process. Handlers get their bot's BotApp as `app`.
+    """
 
-#     current_timestamp = datetime.datetime.now().timestamp()
-#     last_24_hours = 24 * 60 * 60  # 24 hours in seconds
+    def __init__(self, settings):
+        self.name = settings['NAME']
+        self.admin_ids = settings['ADMIN_USER_IDS']
+        self.admin_password = settings['ADMIN_PASSWORD']
+        for key in PER_BOT_DATA_KEYS:
+            directory = os.path.dirname(settings[key])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+        # Initialize bot and dispatcher
+        self.bot = SharedSessionBot(token=settings['API_TOKEN'], session_pool=session_pool,
+                                    server=api_server)
+        self.dp = Dispatcher(self.bot, storage=SQLiteStorage(settings['FSM_STORAGE_FILE']))
+        # Updates that arrive while warmup() runs wait here
+        self.dp.middleware.setup(ReadinessMiddleware(startup))
+        self.dp.middleware.setup(LoggingMiddleware())
+        self.dp.middleware.setup(InstrumentationMiddleware())
+        self.dp.middleware.setup(BotAppMiddleware(self))
+        self.user_meta = UserMetaStore(settings['USER_META_FILE'])
+        self.dp.middleware.setup(UserMetaMiddleware(self.user_meta))
+        # Acknowledges callbacks and absorbs bursts of repeated taps
+        self.dp.middleware.setup(ThrottlingMiddleware(exempt_user_ids=self.admin_ids))
+
+        # Known users, shared by the new-user filter, /stats and /send_to_all
+        self.user_registry = UserRegistry(settings['USER_IDS_FILE'])
+        # Request events with hourly rollups for the 24h / 7d / 30d windows
+        self.request_log = RequestLog(settings['REQUEST_LOG_FILE'])
+        # Telegram file_ids of chart images this bot already uploaded
+        self.media_cache = MediaCache(settings['MEDIA_CACHE_FILE'])
+        # User statistics, flushed to disk in the background
+        self.stats_sink = StatsSink(settings['USER_STATS_FILE'])
+
+        self.broadcaster = Broadcaster(self.bot)
+        # Unreachable users are skipped by later broadcasts
+        self.broadcaster.listeners.append(self.user_meta.record_delivery)
+        # Broadcasts are checkpointed to disk so they survive restarts
+        self.broadcast_jobs = BroadcastJobManager(self.broadcaster, settings['BROADCASTS_DIR'])
+        # Entry-zone alerts, notified through the broadcaster's rate limits
+        self.alert_manager = AlertManager(self.broadcaster, settings['ALERTS_FILE'])
+        self._tasks = []
+
+        register_handlers(self.dp, self)
+
+    def loaders(self):
+        """Returns (name, function) pairs that load this bot's state from disk."""
+
+        loaders = [
+            ('user registry', self.user_registry.load),
+            ('request log', self.request_log.load),
+            ('media cache', self.media_cache.load),
+            ('stats', self.stats_sink.load),
+            ('user metadata', self.user_meta.load),
+            ('alerts', self.alert_manager.load),
+            ('broadcast jobs', self.broadcast_jobs.load),
+        ]
+        if self.name != MAIN_BOT_NAME:
+            loaders = [(f"{self.name} {name}", func) for name, func in loaders]
+        return loaders
+
+    async def _compact_user_ids_periodically(self):
+        """Periodically rewrites the user IDs file to drop duplicate appends."""
+
+        while True:
+            await asyncio.sleep(USER_IDS_COMPACT_INTERVAL)
+            if self.user_registry.needs_compaction():
+                try:
+                    await self.user_registry.compact_async()
+                except OSError as e:
+                    print(f"Error compacting user IDs file: {str(e)}")
+
+    def start(self):
+        """Starts the background tasks of this bot."""
+
+        self._tasks.append(asyncio.ensure_future(self._compact_user_ids_periodically()))
+        self.stats_sink.start()
+        self.request_log.start()
+        self.broadcast_jobs.resume_all()
+        self.alert_manager.start()
+        self.user_meta.start()
+
+    async def close(self):
+        """Flushes in-memory state to disk."""
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.user_registry.needs_compaction(threshold=1):
+            self.user_registry.compact()
+        await self.stats_sink.close()
+        await self.request_log.close()
+        await self.broadcast_jobs.close()
+        await self.alert_manager.close()
+        await self.user_meta.close()
+
+    async def close_storage(self):
+        await self.dp.storage.close()
+        await self.dp.storage.wait_closed()
+
+
+def count_requests_last_24_hours(request_log):
+    """Counts user requests in the last 24 hours."""
+
+    return request_log.count('24h')
+
+
+def count_requests_last_7_days(request_log):
+    """Counts user requests in the last 7 days."""
+
+    return request_log.count('7d')
+
+
+def count_requests_last_month(request_log):
+    """Counts user requests in the last month."""
+
+    return request_log.count('30d')
+
+
+def format_breakdown(request_log, kind):
+    """Formats per-coin or per-timeframe request counts for the 24h / 7d / 30d windows."""
+
+    windows = ['24h', '7d', '30d']
+    counts = {window: request_log.breakdown(window, kind) for window in windows}
+    names = sorted(counts['30d'], key=counts['30d'].get, reverse=True)
+    return "\n".join(
+        f"{name}: " + " / ".join(str(counts[window].get(name, 0)) for window in windows)
+        for name in names)
 
-#     count = 0
-#     for user_id, timestamp in user_request_timestamps.items():
-#         if current_timestamp - timestamp <= last_24_hours:
-#             count += 1
 
-#     return count
+async def send_chart(app, chat_id, coin, timeframe, image_path, caption, reply_markup=None):
+    """Sends a chart image, reusing its Telegram file_id when possible."""
 
+    file_id = app.media_cache.get(coin, timeframe, image_path)
+    if file_id is not None:
+        try:
+            with metrics.timer('chart_send_seconds', source='file_id'):
+                return await app.bot.send_photo(chat_id, photo=file_id, caption=caption,
+                                                reply_markup=reply_markup)
+        except exceptions.BadRequest as e:
+            print(f"Cached file_id for {coin} ({timeframe}) rejected: {str(e)}")
+            app.media_cache.invalidate(coin, timeframe)
+
+    with metrics.timer('chart_send_seconds', source='upload'):
+        with open(image_path, 'rb') as image_file:
+            sent = await app.bot.send_photo(chat_id, photo=image_file, caption=caption,
+                                            reply_markup=reply_markup)
+    app.media_cache.put(coin, timeframe, image_path, sent.photo[-1].file_id)
+    await app.media_cache.save_async()
+    return sent
 
-# def count_requests_last_7_days():
-#     """Counts user requests in the last 7 days."""
 
-#     current_timestamp = datetime.datetime.now().timestamp()
-#     last_7_days = 7 * 24 * 60 * 60  # 7 days in seconds
+async def send_charts(app, chat_id, coin, charts):
+    """Sends several charts of a coin as one media group.
 
-#     count = 0
-#     for user_id, timestamp in user_request_timestamps.items():
-#         if current_timestamp - timestamp <= last_7_days:
-#             count += 1
+    `charts` is a list of (timeframe, image_path, caption). Cached file_ids
+    are used where possible; if Telegram rejects one, the whole group is
+    sent again as uploads.
+    """
 
-#     return count
+    for use_cache in (True, False):
+        media = types.MediaGroup()
+        files = []
+        uploaded = []
+        try:
+            for timeframe, image_path, caption in charts:
+                file_id = app.media_cache.get(coin, timeframe, image_path) if use_cache else None
+                if file_id is None:
+                    files.append(open(image_path, 'rb'))
+                    uploaded.append(len(media.media))
+                    media.attach_photo(types.InputMediaPhoto(
+                        types.InputFile(files[-1]), caption=caption))
+                else:
+                    media.attach_photo(types.InputMediaPhoto(file_id, caption=caption))
+            source = 'upload' if uploaded else 'file_id'
+            with metrics.timer('chart_send_seconds', source=f"media_group_{source}"):
+                sent = await app.bot.send_media_group(chat_id, media)
+            break
+        except exceptions.BadRequest as e:
+            if not use_cache or len(uploaded) == len(charts):
+                raise
+            print(f"Cached file_ids for {coin} rejected: {str(e)}")
+            for timeframe, _, _ in charts:
+                app.media_cache.invalidate(coin, timeframe)
+        finally:
+            for file in files:
+                file.close()
+
+    for index in uploaded:
+        timeframe, image_path, _ = charts[index]
+        app.media_cache.put(coin, timeframe, image_path, sent[index].photo[-1].file_id)
+    if uploaded:
+        await app.media_cache.save_async()
+    return sent
 
 
-# def count_requests_last_month():
-#     """Counts user requests in the last month."""
+def go_back_button():
+    """Returns the pre-rendered "Go Back" inline keyboard."""
 
-#     current_timestamp = datetime.datetime.now().timestamp()
-#     last_month = 30 * 24 * 60 * 60  # Approximately 30 days in seconds
+    return render.go_back_keyboard
 
-#     count = 0
-#     for user_id, timestamp in user_request_timestamps.items():
-#         if current_timestamp - timestamp <= last_month:
-#             count += 1
 
-#     return count
+# Price ticks are matched against the alerts of every hosted bot
+price_feeds = []
 
 
-def update_request_counts():
-    """Updates various request count variables."""
+def on_price_tick(coin, price):
+    for app in apps:
+        app.alert_manager.on_tick(coin, price)
 
-    global request_count_24h, request_count_7d, request_count_30d, total_request_count
 
-    with open(USER_STATS_FILE, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            request_count_24h = int(row['day'])
-            request_count_7d = int(row['week'])
-            request_count_30d = int(row['month'])
-            total_request_count = int(row['total'])
+if PRICE_FEED_FILE:
+    price_feeds.append(FilePriceFeed(PRICE_FEED_FILE, on_price_tick))
+if PRICE_FEED_PORT:
+    price_feeds.append(SocketPriceFeed('127.0.0.1', PRICE_FEED_PORT, on_price_tick))
 
 
-def go_back_button():
-    """Generates a "Go Back" button for inline keyboard."""
+def send_message_to_all_users(app, message_text, user_ids, report_chat_id=None):
 
-    button = types.InlineKeyboardButton("Go Back", callback_data="go_back")
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(button)
-    return keyboard
+    """ Starts a resumable broadcast of a message to all users."""
 
+    return app.broadcast_jobs.start(message_text, user_ids,
+                                    report_chat_id=report_chat_id)
 
-async def send_message_to_all_users(message_text, user_ids):
 
-    """ Sends a message to all users."""
-
-    for user_id in user_ids:
-        try:
-            await bot.send_message(user_id, message_text)
-        except Exception as e:
-            print(f"Error sending message to user {user_id}: {str(e)}")
-
-
-def read_data():
-    """Reads data from a CSV file."""
-
-    crypto_data = {}
-    with open(CSV_FILE, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            coin = row['coin']
-            crypto_data[coin] = {
-                'day': {
-                    'price': float(row['day_price']),
-                    'image': row['day_image']
-                },
-                'week': {
-                    'price': float(row['week_price']),
-                    'image': row['week_image']
-                },
-                'month': {
-                    'price': float(row['month_price']),
-                    'image': row['month_image']
-                }
-            }
-    return crypto_data
-
-# Function to write data to the CSV file
-
-
-def read_user_stats():
-    """Reads user statistics from a CSV file."""
-
-    user_stats = {
-        'day': 0,
-        'week': 0,
-        'month': 0,
-        'total': 0,
-        'last_update_week': None
-    }
-    try:
-        with open(USER_STATS_FILE, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                user_stats['day'] = int(row['day'])
-                user_stats['week'] = int(row['week'])
-                user_stats['month'] = int(row['month'])
-                user_stats['total'] = int(row['total'])
-                user_stats['last_update_week'] = row['last_update_week']
-    except FileNotFoundError:
-        pass  # If the file doesn't exist, start with default values
-    return user_stats
-
-
-def write_data(crypto_data):
-    """Writes data to a CSV file."""
-
-    with open(CSV_FILE, 'w', newline='') as csvfile:
-        fieldnames = ['coin', 'day_price', 'day_image',
-                      'week_price', 'week_image', 'month_price', 'month_image']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for coin, data in crypto_data.items():
-            writer.writerow({
-                'coin': coin,
-                'day_price': data['day']['price'],
-                'day_image': data['day']['image'],
-                'week_price': data['week']['price'],
-                'week_image': data['week']['image'],
-                'month_price': data['month']['price'],
-                'month_image': data['month']['image']
-            })
-
-
-async def update_user_statistics():
-
-    """Updates user statistics."""
-
-    global user_statistics
-
-    current_week = datetime.date.today().isocalendar()[1]
-
-    if user_statistics['last_update_week'] != str(current_week):
-        user_statistics['week'] = 0
-        user_statistics['last_update_week'] = str(current_week)
-
-    user_statistics['day'] += 1
-    user_statistics['week'] += 1
-    user_statistics['month'] += 1
-    user_statistics['total'] += 1
-
-    # Write updated user statistics to CSV file
-    with open(USER_STATS_FILE, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=USER_STATS_FIELDNAMES)
-        writer.writeheader()
-        writer.writerow(user_statistics)
-
-
-@dp.message_handler(lambda message: message.from_user.id not in read_user_ids(USER_IDS_FILE))
-async def handle_new_user(message: types.Message):
+async def handle_new_user(message: types.Message, app):
 
     """Handles new user registrations."""
     user_id = message.from_user.id
-    user_ids = read_user_ids(USER_IDS_FILE)
-
-    if user_id not in user_ids:
-        user_ids.append(user_id)
-        store_user_ids(user_ids, USER_IDS_FILE)
+    app.user_registry.add(user_id)
 
 
-@dp.message_handler(commands=['send_to_all'], state='*')
-async def send_to_all_users(message: types.Message):
+async def send_to_all_users(message: types.Message, state: FSMContext, app):
 
     """Handles the command to send a message to all users."""
     user_id = message.from_user.id
-    if user_id in ADMIN_USER_IDS:
+    if user_id in app.admin_ids:
         await message.answer("Enter the message you want to send to all users:")
         await Form.send_message_to_all.set()
+        await state.update_data(recipients=None)
     else:
         await message.answer("You are not authorized to use this command.")
 
 
-@dp.message_handler(state=Form.send_message_to_all)
-async def process_send_message_to_all(message: types.Message, state: FSMContext):
+async def send_to_segment(message: types.Message, state: FSMContext, app):
+
+    """Handles the command to send a message to users in the given segments."""
+    if message.from_user.id not in app.admin_ids:
+        await message.answer("You are not authorized to use this command.")
+        return
+    terms = message.get_args().split()
+    if not terms:
+        await message.answer("Usage: /send_to_segment active:7d coin:Bitcoin lang:ru\n"
+                             "Users must be in every segment given.")
+        return
+    try:
+        recipients = app.user_meta.select(terms)
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+    await message.answer(f"{len(recipients)} users in {' '.join(terms)}. "
+                         f"Enter the message you want to send to them:")
+    await Form.send_message_to_all.set()
+    await state.update_data(recipients=recipients)
+
+
+async def process_send_message_to_all(message: types.Message, state: FSMContext, app):
 
     """Processes the message to be sent to all users."""
     user_id = message.from_user.id
-    if user_id in ADMIN_USER_IDS:
-        user_ids = read_user_ids(USER_IDS_FILE)
+    if user_id in app.admin_ids:
+        data = await state.get_data()
+        user_ids = data.get('recipients')
+        if user_ids is None:
+            user_ids = app.user_meta.deliverable(app.user_registry)
         message_text = message.text
 
-        await send_message_to_all_users(message_text, user_ids)
-        await message.answer(f"Message sent to {len(user_ids)} users.")
+        # The broadcast runs in the background, progress is reported to the admin
+        job = send_message_to_all_users(
+            app, message_text, user_ids, report_chat_id=message.chat.id)
+        await message.answer(
+            f"Sending message to {len(user_ids)} users (broadcast {job.job_id}).\n"
+            f"Use /pause_broadcast {job.job_id} or /cancel_broadcast {job.job_id} to stop it.")
         await state.finish()
     else:
         await message.answer("You are not authorized to use this command.")
 
 
-@dp.message_handler(commands=['send_to_all'], state='*')
-async def send_to_all_users(message: types.Message):
+async def list_broadcasts(message: types.Message, app):
 
-    """Handles the command to send a message to all users."""
-    user_id = message.from_user.id
-    if user_id in ADMIN_USER_IDS:
-        await message.answer("Enter the message you want to send to all users:")
-        await Form.send_message.set()
+    """Lists unfinished broadcasts to admins."""
+    if message.from_user.id in app.admin_ids:
+        await message.answer(app.broadcast_jobs.describe() or "No active broadcasts.")
     else:
         await message.answer("You are not authorized to use this command.")
 
 
-# Load data from CSV file at startup
-crypto_data = read_data()
+async def control_broadcast(message: types.Message, app):
+
+    """Pauses, resumes or cancels a broadcast by its ID."""
+    if message.from_user.id not in app.admin_ids:
+        await message.answer("You are not authorized to use this command.")
+        return
+    command = message.get_command(pure=True)
+    job_id = message.get_args().strip()
+    actions = {
+        'pause_broadcast': app.broadcast_jobs.pause,
+        'resume_broadcast': app.broadcast_jobs.resume,
+        'cancel_broadcast': app.broadcast_jobs.cancel,
+    }
+    if actions[command](job_id):
+        await message.answer(f"Broadcast {job_id}: {app.broadcast_jobs.jobs[job_id].status}.")
+    else:
+        await message.answer(f"No broadcast {job_id} that can be changed this way.")
+
+
+# Loaded from the CSV file during warmup, reloaded when the file changes.
+# The catalog and everything derived from it are shared by all hosted bots.
+# Every version of it is kept in the price history.
+price_history = PriceHistory(PRICE_HISTORY_DIR, TIMEFRAMES)
+catalog = CatalogStore(CSV_FILE, history=price_history)
+
+# Keyboards and captions, re-rendered only when the catalog changes
+render = RenderCache()
+catalog.listeners.append(render.rebuild)
+
+# Coin names and tickers for inline search, re-indexed when the catalog changes
+coin_index = CoinIndex()
+catalog.listeners.append(coin_index.rebuild)
+INLINE_COINS_PER_PAGE = 16  # Three results per coin, Telegram allows 50 per answer
+INLINE_CACHE_TIME = 60  # seconds
+
+# Entry zones and stop/take levels computed from candle history, created
+# during warmup when HISTORY_DIR exists so NumPy is not imported otherwise
+analysis_engine = None
+
+
+async def refresh_analysis_periodically():
+    """Recomputes levels of coins whose history files have grown."""
+
+    while True:
+        try:
+            await analysis_engine.refresh_catalog(catalog)
+        except Exception as e:
+            # e.g. a coin removed by a CSV reload or malformed history; the next pass may work
+            print(f"Error refreshing analysis: {e!r}")
+        await asyncio.sleep(ANALYSIS_INTERVAL)
+
+
+# Levels sent to users by every hosted bot, kept for /backtest
+recommendation_log = RecommendationLog(RECOMMENDATIONS_DIR)
+# Created by the first /backtest, keeps the history it has read
+backtester = None
+backtest_lock = asyncio.Lock()
 
-# Start command
-# Initialize user statistics
-user_statistics = read_user_stats()
 
-user_request_timestamps = {}
+# Charts drawn from candle history, rendered off the event loop
+chart_renderer = ChartRenderer(CHART_CACHE_DIR, max_entries=CHART_CACHE_SIZE)
 
 
+async def chart_image(coin, timeframe):
+    """Returns the rendered chart of a coin and timeframe, or the uploaded image."""
+
+    entry = catalog.data[coin][timeframe]
+    history = analysis_engine.chart_candles(coin, timeframe) if analysis_engine else None
+    if history is not None:
+        last_timestamp, candles = history
+        path = await chart_renderer.chart(coin, timeframe, last_timestamp, candles, entry)
+        if path is not None:
+            return path
+    return entry['image']
+
 # Admin password entry
 
 
-@dp.message_handler(state=Form.password)
-async def process_password(message: types.Message, state: FSMContext):
+async def process_password(message: types.Message, state: FSMContext, app):
 
     """Processes the entered password for admin access."""
-    if message.text == ADMIN_PASSWORD:
+    if message.text == app.admin_password:
         await message.answer("Password correct. You can now edit the database.")
         await show_coins(message, state, Form.edit_coin)
     else:
@@ -326,28 +457,68 @@ async def process_password(message: types.Message, state: FSMContext):
 # Show coins for selection
 
 
-@dp.callback_query_handler(lambda c: c.data in crypto_data, state=[Form.edit_coin, Form.user_coin])
-async def process_coin(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_coin(callback_query: types.CallbackQuery, state: FSMContext, app):
 
     """Processes the selected coin for editing."""
     coin = callback_query.data
     await state.update_data(coin=coin)
-    keyboard = types.InlineKeyboardMarkup()
-    for timeframe in ["Day", "Week", "Month"]:
-        button = types.InlineKeyboardButton(
-            timeframe, callback_data=timeframe.lower())
-        keyboard.row(button)
-    keyboard.row(types.InlineKeyboardButton(
-        "Go Back", callback_data="go_back"))  # Add "Go Back" button
-    await callback_query.message.answer(f"Selected {coin}. Choose timeframe:", reply_markup=keyboard)
     current_state = await state.get_state()
+    if current_state == Form.user_coin.state:
+        app.user_meta.add_interest(callback_query.from_user.id, coin)
+        keyboard = render.user_timeframe_keyboard
+    else:
+        keyboard = render.timeframe_keyboard
+    await callback_query.message.answer(f"Selected {coin}. Choose timeframe:",
+                                        reply_markup=keyboard)
     next_state = Form.edit_timeframe if current_state == Form.edit_coin.state else Form.user_timeframe
     await next_state.set()
 
+
+async def process_coins_page(callback_query: types.CallbackQuery):
+
+    """Switches the coin picker to another page."""
+    try:
+        keyboard = render.coins_page(int(callback_query.data[len('coins_page:'):]))
+    except ValueError:
+        keyboard = None
+    if keyboard is None:
+        return  # A page of an older, longer catalog
+    try:
+        await callback_query.message.edit_reply_markup(keyboard)
+    except exceptions.MessageNotModified:
+        pass
+
+
+async def inline_search(inline_query: types.InlineQuery, app):
+
+    """Answers "@bot <coin or ticker>" with the analysis of the matching coins."""
+    coins = coin_index.search(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    results = []
+    for position, coin in enumerate(coins[offset:offset + INLINE_COINS_PER_PAGE], offset):
+        if coin not in catalog.data:
+            continue  # Removed after the query was indexed
+        for timeframe in TIMEFRAMES:
+            result_id = f"{position}:{timeframe}"
+            title = f"{coin} ({timeframe})"
+            caption = render.caption(coin, timeframe)
+            # Only images already uploaded can be sent, the others are sent as text
+            file_id = app.media_cache.latest(coin, timeframe)
+            if file_id is not None:
+                results.append(types.InlineQueryResultCachedPhoto(
+                    id=result_id, photo_file_id=file_id, title=title, caption=caption))
+            else:
+                results.append(types.InlineQueryResultArticle(
+                    id=result_id, title=title,
+                    description=f"{catalog.data[coin][timeframe]['price']} $",
+                    input_message_content=types.InputTextMessageContent(caption)))
+    next_offset = offset + INLINE_COINS_PER_PAGE
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME,
+                              next_offset=str(next_offset) if next_offset < len(coins) else '')
+
 # Timeframe selection for Admin
 
 
-@dp.callback_query_handler(lambda c: c.data in ["day", "week", "month"], state=Form.edit_timeframe)
 async def process_edit_timeframe(callback_query: types.CallbackQuery, state: FSMContext):
 
     """Processes the selected timeframe for editing."""
@@ -359,7 +530,6 @@ async def process_edit_timeframe(callback_query: types.CallbackQuery, state: FSM
 # Handler for editing the price and image
 
 
-@dp.message_handler(state=Form.edit_price)
 async def process_edit_price(message: types.Message, state: FSMContext):
 
     """Processes the entered price for editing."""
@@ -369,7 +539,8 @@ async def process_edit_price(message: types.Message, state: FSMContext):
         try:
             price = float(message.text)
             await message.answer(f"Updating price for {coin} ({timeframe}) to: {price}")
-            crypto_data[coin][timeframe]['price'] = price
+            # Staged until the image arrives, then committed together
+            data['price'] = price
             await message.answer("Now, please send the new image for this coin and timeframe (Day, Week, Month):")
             await Form.edit_image.set()
         except ValueError:
@@ -378,8 +549,7 @@ async def process_edit_price(message: types.Message, state: FSMContext):
 # Handler for receiving the new image
 
 
-@dp.message_handler(content_types=['photo'], state=Form.edit_image)
-async def receive_image(message: types.Message, state: FSMContext):
+async def receive_image(message: types.Message, state: FSMContext, app):
 
     """Processes the received image for editing."""
     photo = message.photo[-1]  # Get the largest photo
@@ -388,64 +558,118 @@ async def receive_image(message: types.Message, state: FSMContext):
         coin = data['coin']
         timeframe = data['timeframe']
         file_path = os.path.join(IMAGE_DIR, coin, f"{timeframe}.png")
-        file_info = await bot.get_file(file_id)
-        file = await bot.download_file(file_info.file_path)
 
-        # Save the downloaded file to the specified path
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'wb') as new_image:
-            new_image.write(file.read())
-
-        crypto_data[coin][timeframe]['image'] = file_path
-        write_data(crypto_data)
-        await message.answer("Image updated successfully.")
+        # Streamed to a temp file, normalised off the event loop and swapped in atomically
+        try:
+            await ingest_image(app.bot, file_id, file_path)
+        except (ImageRejected, aiohttp.ClientError, exceptions.TelegramAPIError) as e:
+            await message.answer(f"Could not use this image: {str(e)}. Please send another one:")
+            return
+        # The image is shared, so no bot may serve the old one from its file_id
+        for hosted in apps:
+            hosted.media_cache.invalidate(coin, timeframe)
+
+        edit = catalog.begin().set(coin, timeframe, image=file_path)
+        if 'price' in data:
+            edit.set(coin, timeframe, price=data['price'])
+        await catalog.commit(edit)
+
+        # The preview upload also caches the new image's file_id for users
+        await send_chart(app, message.chat.id, coin, timeframe, file_path,
+                         caption="Image updated successfully.")
     await state.reset_state()
 
 # Timeframe selection for User
 
 
-@dp.callback_query_handler(lambda c: c.data in ["day", "week", "month"], state=Form.user_timeframe)
-async def process_user_timeframe(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_user_timeframe(callback_query: types.CallbackQuery, state: FSMContext, app):
 
     """Processes the selected timeframe for user requests."""
-    global total_request_count
     timeframe = callback_query.data
     user_id = callback_query.from_user.id
 
     async with state.proxy() as data:
-        price = crypto_data[data['coin']][timeframe]['price']
-        image_path = crypto_data[data['coin']][timeframe]['image']
-
-        # Get the current timestamp
-        current_timestamp = datetime.datetime.now().timestamp()
-
-        # Store the timestamp for the user's request
-        user_request_timestamps[user_id] = current_timestamp
-        additional_data = {
-            "day": (1.3, 4),
-            "week": (3, 10),
-            "month": (14, 44),
-        }
-        with open(image_path, 'rb') as image_file:
-            await bot.send_photo(
-                callback_query.from_user.id,
-                photo=image_file,
-                caption=(
-                    f"Cудя по анализу за последние недели, лучшая зона для покупок {data['coin']} ({timeframe}) это зона : {price} $"
-                    f"\n\n\nМожно поставить от этой цены стоп-лосс {additional_data[timeframe][0]}%, и тейк {additional_data[timeframe][1]}%"
-                ),
-                reply_markup=go_back_button()
-            )
-
-        # Increment total_request_count
-        total_request_count += 1
+        image_path = await chart_image(data['coin'], timeframe)
+
+        # Log the request for the windowed statistics
+        app.request_log.record(user_id, data['coin'], timeframe)
+        recommendation_log.record(data['coin'], timeframe, catalog.data[data['coin']][timeframe])
+        sent = await send_chart(
+            app,
+            callback_query.from_user.id,
+            data['coin'],
+            timeframe,
+            image_path,
+            caption=render.caption(data['coin'], timeframe),
+            reply_markup=render.result_keyboard(data['coin'], timeframe)
+        )
 
         # Update user statistics
-        await update_user_statistics()
+        app.stats_sink.increment()
+
+    # Returned so a repeated tap can be answered with a copy of it
+    return sent
+
 
+async def process_all_timeframes(callback_query: types.CallbackQuery, state: FSMContext, app):
+
+    """Sends the Day, Week and Month analysis of a coin in one media group."""
+    user_id = callback_query.from_user.id
+    timeframes = ["day", "week", "month"]
+
+    data = await state.get_data()
+    coin = data['coin']
+    image_paths = await asyncio.gather(*[chart_image(coin, timeframe) for timeframe in timeframes])
+    await send_charts(app, user_id, coin, [
+        (timeframe, image_path, render.caption(coin, timeframe))
+        for timeframe, image_path in zip(timeframes, image_paths)])
+
+    # The three requests are recorded together
+    for timeframe in timeframes:
+        app.request_log.record(user_id, coin, timeframe)
+        recommendation_log.record(coin, timeframe, catalog.data[coin][timeframe])
+    app.stats_sink.increment(len(timeframes))
+
+
+async def subscribe_alert(callback_query: types.CallbackQuery, app):
+
+    """Subscribes the user to an alert on the entry zone of a coin and timeframe."""
+    coin, timeframe = callback_query.data[len('alert:'):].rsplit(':', 1)
+    if coin not in catalog.data or timeframe not in ["day", "week", "month"]:
+        await callback_query.message.answer("This coin is no longer available.")
+        return
+    threshold = catalog.data[coin][timeframe]['price']
+    app.alert_manager.subscribe(callback_query.from_user.id, coin, timeframe, threshold)
+    await callback_query.message.answer(
+        f"You will be notified when {coin} reaches {threshold} $. See /alerts.")
+
+
+async def list_alerts(message: types.Message, app):
+
+    """Lists the user's price alerts with buttons to cancel them."""
+    alerts = app.alert_manager.user_alerts(message.from_user.id)
+    if not alerts:
+        await message.answer("You have no price alerts.")
+        return
+    keyboard = types.InlineKeyboardMarkup()
+    for coin, timeframe, threshold in alerts:
+        keyboard.add(types.InlineKeyboardButton(
+            f"Cancel {coin} ({timeframe}) at {threshold} $",
+            callback_data=f"unalert:{coin}:{timeframe}"))
+    await message.answer("Your price alerts:", reply_markup=keyboard)
 
-@dp.message_handler(commands='start', state='*')
-async def cmd_start(message: types.Message, callback_query: types.CallbackQuery = None):
+
+async def cancel_alert(callback_query: types.CallbackQuery, app):
+
+    """Cancels one of the user's price alerts."""
+    coin, timeframe = callback_query.data[len('unalert:'):].rsplit(':', 1)
+    if app.alert_manager.unsubscribe(callback_query.from_user.id, coin, timeframe):
+        await callback_query.message.answer(f"Alert for {coin} ({timeframe}) cancelled.")
+    else:
+        await callback_query.message.answer("This alert is no longer active.")
+
+
+async def cmd_start(message: types.Message, app, callback_query: types.CallbackQuery = None):
 
     """Handles the start command and role selection for users."""
     user_id = message.from_user.id
@@ -477,20 +701,8 @@ async def cmd_start(message: types.Message, callback_query: types.CallbackQuery
     """
     )
 
-    if user_id in ADMIN_USER_IDS:
-        # If the user is an admin, show both options
-        keyboard = types.InlineKeyboardMarkup()
-        admin_button = types.InlineKeyboardButton(
-            "Admin", callback_data="admin")
-        user_button = types.InlineKeyboardButton("User", callback_data="user")
-        keyboard.row(admin_button, user_button)
-        text = "Choose your role:"
-    else:
-        # If the user is not an admin, show only the user option
-        keyboard = types.InlineKeyboardMarkup()
-        user_button = types.InlineKeyboardButton("User", callback_data="user")
-        keyboard.row(user_button)
-        text = "Choose your role:"
+    # Admins get both the Admin and User options, everyone else only User
+    keyboard = render.role_keyboard(user_id in app.admin_ids)
 
     if callback_query:
         await callback_query.message.edit_text(welcome_text, reply_markup=keyboard)
@@ -500,8 +712,7 @@ async def cmd_start(message: types.Message, callback_query: types.CallbackQuery
     await Form.role.set()
 
 
-@dp.callback_query_handler(lambda c: c.data == "go_back", state="*")
-async def go_back(callback_query: types.CallbackQuery, state: FSMContext):
+async def go_back(callback_query: types.CallbackQuery, state: FSMContext, app):
     current_state = await state.get_state()
 
     if current_state == "Form:edit_price":
@@ -509,23 +720,23 @@ async def go_back(callback_query: types.CallbackQuery, state: FSMContext):
         await show_coins(callback_query.message, state, Form.edit_coin, callback_query=callback_query)
     elif current_state == "Form:edit_timeframe":
         # Edit the message to show the role selection keyboard
-        await cmd_start(callback_query.message, callback_query=callback_query)
+        await cmd_start(callback_query.message, app, callback_query=callback_query)
     elif current_state == "Form:edit_coin":
         # Edit the message to ask for the admin password
         await callback_query.message.edit_text("Enter admin password:")
         await Form.password.set()
     elif current_state == "Form:password":
         # Edit the message to show the role selection keyboard
-        await cmd_start(callback_query.message, callback_query=callback_query)
+        await cmd_start(callback_query.message, app, callback_query=callback_query)
     elif current_state == "Form:user_timeframe":
         # Edit the message to show the coin selection keyboard
         await show_coins(callback_query.message, state, Form.user_coin, callback_query=callback_query)
     elif current_state == "Form:user_coin":
         # Edit the message to show the role selection keyboard
-        await cmd_start(callback_query.message, callback_query=callback_query)
+        await cmd_start(callback_query.message, app, callback_query=callback_query)
     elif current_state == "Form:role":
         # Edit the message to restart
-        await cmd_start(callback_query.message, callback_query=callback_query)
+        await cmd_start(callback_query.message, app, callback_query=callback_query)
     else:
         # Handle other cases if needed
         pass
@@ -534,11 +745,7 @@ async def go_back(callback_query: types.CallbackQuery, state: FSMContext):
 async def show_coins(message, state, next_state, callback_query=None):
 
     """Displays a list of available coins to the user."""
-    keyboard = InlineKeyboardMarkup()
-    for coin in crypto_data:
-        button = InlineKeyboardButton(coin, callback_data=coin)
-        keyboard.row(button)
-    keyboard.row(InlineKeyboardButton("Go Back", callback_data="go_back"))
+    keyboard = render.coins_keyboard
     text = "Choose a coin:"
 
     # Check if it's a callback_query and edit the message accordingly
@@ -549,7 +756,6 @@ async def show_coins(message, state, next_state, callback_query=None):
     await next_state.set()
 
 
-@dp.callback_query_handler(lambda c: c.data in ["admin", "user"], state=Form.role)
 async def process_role(callback_query: types.CallbackQuery, state: FSMContext):
 
     """Processes the selected role (admin or user) for users."""
@@ -562,39 +768,228 @@ async def process_role(callback_query: types.CallbackQuery, state: FSMContext):
         await show_coins(callback_query.message, state, Form.user_coin, callback_query)
 
 
-@dp.message_handler(commands='stats')
-async def show_user_stats(message: types.Message):
+async def show_user_stats(message: types.Message, app):
 
     """Displays user statistics to admins."""
     user_id = message.from_user.id
-    print(user_id)
-    print(ADMIN_USER_IDS)
-    if user_id in ADMIN_USER_IDS:
-        global request_count_24h, request_count_7d, request_count_30d, total_request_count, user_statistics
-        # Read user statistics from the CSV file
-        user_statistics = read_user_stats()
-
-        # Update the variables
-        request_count_24h = user_statistics['day']
-        request_count_7d = user_statistics['week']
-        request_count_30d = user_statistics['month']
-        total_request_count = user_statistics['total']
-        user_ids = read_user_ids(USER_IDS_FILE)
-        num_users = len(user_ids)
+    if user_id in app.admin_ids:
+        # Read the counts from the in-memory rollups
+        request_log = app.request_log
+        num_users = len(app.user_registry)
         # Display the updated statistics
         stats_message = (
-            # f"User Request Statistics:\n"
-            # f"Requests in the last 24 hours: {request_count_24h}\n"
-            # f"Requests in the last 7 days: {request_count_7d}\n"
-            # f"Requests in the last month: {request_count_30d}\n"
-            f"Total requests: {total_request_count}"
+            f"User Request Statistics:\n"
+            f"Requests in the last 24 hours: {count_requests_last_24_hours(request_log)}\n"
+            f"Requests in the last 7 days: {count_requests_last_7_days(request_log)}\n"
+            f"Requests in the last month: {count_requests_last_month(request_log)}\n"
+            f"\nBy coin (24h / 7d / 30d):\n{format_breakdown(request_log, 'coin')}\n"
+            f"\nBy timeframe (24h / 7d / 30d):\n{format_breakdown(request_log, 'timeframe')}\n"
+            f"\nTotal requests: {app.stats_sink.stats['total']}"
             f"\nTotal users: {num_users}"
+            f"\nActive users (7d): {len(app.user_meta.segment('active:7d'))}"
+            f"\nUnreachable users: {len(app.user_meta.dead)}"
         )
         await message.answer(stats_message)
     else:
         await message.answer("You are not authorized to use this command.")
 
 
+async def show_perf(message: types.Message, app):
+
+    """Displays handler, API, disk and storage latency to admins."""
+    if message.from_user.id in app.admin_ids:
+        await message.answer(format_perf() + "\n\n" + startup.report())
+    else:
+        await message.answer("You are not authorized to use this command.")
+
+
+async def refresh_analysis(message: types.Message, app):
+
+    """Recomputes prices and stop/take levels from candle history for admins."""
+    if message.from_user.id not in app.admin_ids:
+        await message.answer("You are not authorized to use this command.")
+    elif analysis_engine is None:
+        await message.answer(f"There is no history directory {HISTORY_DIR}.")
+    else:
+        updated = await analysis_engine.refresh_catalog(catalog)
+        await message.answer(f"Analysis refreshed, {updated} coin timeframes updated.")
+
+
+async def run_backtest(message: types.Message, app):
+
+    """Replays the recommendations sent so far against candle history for admins."""
+    global backtester
+    if message.from_user.id not in app.admin_ids:
+        await message.answer("You are not authorized to use this command.")
+        return
+    if not os.path.isdir(HISTORY_DIR):
+        await message.answer(f"There is no history directory {HISTORY_DIR}.")
+        return
+    coins = message.get_args().split() or list(catalog.data)
+    await recommendation_log.flush()
+    if backtester is None:
+        from backtest import Backtester
+        backtester = Backtester(HISTORY_DIR, RECOMMENDATIONS_DIR)
+    loop = asyncio.get_event_loop()
+    async with backtest_lock:
+        with metrics.timer('backtest_seconds'):
+            results = await loop.run_in_executor(None, backtester.run, coins)
+    if not results:
+        await message.answer("No recommendations with candle history to backtest yet.")
+        return
+    from backtest import format_backtest
+    for part in safe_split_text(format_backtest(results)):
+        await message.answer(part)
+
+
+async def show_price_history(message: types.Message, app):
+
+    """Lists the last recorded changes of a coin and timeframe for admins."""
+    if message.from_user.id not in app.admin_ids:
+        await message.answer("You are not authorized to use this command.")
+        return
+    # The coin name can contain spaces, the timeframe is the last argument
+    coin, _, timeframe = message.get_args().rpartition(' ')
+    if coin not in catalog.data or timeframe not in TIMEFRAMES:
+        await message.answer("Usage: /price_history <coin> <day|week|month>")
+        return
+    loop = asyncio.get_event_loop()
+    rows = await loop.run_in_executor(None, price_history.range, coin, timeframe)
+    await message.answer(format_price_history(coin, timeframe, rows))
+
+
+def register_handlers(dp, app):
+    """Registers every handler on the dispatcher of a hosted bot, in priority order."""
+
+    dp.register_message_handler(
+        handle_new_user, lambda message: message.from_user.id not in app.user_registry)
+    dp.register_message_handler(send_to_all_users, commands=['send_to_all'], state='*')
+    dp.register_message_handler(send_to_segment, commands=['send_to_segment'], state='*')
+    dp.register_message_handler(process_send_message_to_all, state=Form.send_message_to_all)
+    dp.register_message_handler(list_broadcasts, commands=['broadcasts'], state='*')
+    dp.register_message_handler(
+        control_broadcast, commands=['pause_broadcast', 'resume_broadcast', 'cancel_broadcast'],
+        state='*')
+    dp.register_message_handler(process_password, state=Form.password)
+    dp.register_callback_query_handler(
+        process_coin, lambda c: c.data in catalog.data, state=[Form.edit_coin, Form.user_coin])
+    dp.register_callback_query_handler(
+        process_coins_page, lambda c: c.data.startswith('coins_page:'),
+        state=[Form.edit_coin, Form.user_coin])
+    dp.register_inline_handler(inline_search, state='*')
+    dp.register_callback_query_handler(
+        process_edit_timeframe, lambda c: c.data in ["day", "week", "month"],
+        state=Form.edit_timeframe)
+    dp.register_message_handler(process_edit_price, state=Form.edit_price)
+    dp.register_message_handler(receive_image, content_types=['photo'], state=Form.edit_image)
+    dp.register_callback_query_handler(
+        process_user_timeframe, lambda c: c.data in ["day", "week", "month"],
+        state=Form.user_timeframe)
+    dp.register_callback_query_handler(
+        process_all_timeframes, lambda c: c.data == "all", state=Form.user_timeframe)
+    dp.register_callback_query_handler(
+        subscribe_alert, lambda c: c.data.startswith('alert:'), state='*')
+    dp.register_message_handler(list_alerts, commands='alerts', state='*')
+    dp.register_callback_query_handler(
+        cancel_alert, lambda c: c.data.startswith('unalert:'), state='*')
+    dp.register_message_handler(cmd_start, commands='start', state='*')
+    dp.register_callback_query_handler(go_back, lambda c: c.data == "go_back", state="*")
+    dp.register_callback_query_handler(
+        process_role, lambda c: c.data in ["admin", "user"], state=Form.role)
+    dp.register_message_handler(show_user_stats, commands='stats')
+    dp.register_message_handler(show_perf, commands='perf', state='*')
+    dp.register_message_handler(refresh_analysis, commands='refresh_analysis', state='*')
+    dp.register_message_handler(run_backtest, commands='backtest', state='*')
+    dp.register_message_handler(show_price_history, commands='price_history', state='*')
+
+
+# One BotApp per configured token, all served by this process
+apps = [BotApp(settings) for settings in HOSTED_BOTS]
+startup.mark('bot setup')
+
+metrics.gauge('active_broadcasts', lambda: sum(app.broadcast_jobs.active() for app in apps))
+metrics.gauge('known_users', lambda: sum(len(app.user_registry) for app in apps))
+metrics.gauge('alert_subscriptions',
+              lambda: sum(len(app.alert_manager.subscriptions) for app in apps))
+metrics.gauge('alert_queue_depth', lambda: sum(app.alert_manager.queue.qsize() for app in apps))
+metrics.gauge('hosted_bots', lambda: len(apps))
+
+
+def create_analysis_engine():
+    from analysis import AnalysisEngine
+    return AnalysisEngine(HISTORY_DIR)
+
+
+async def warmup():
+    """Loads state from disk in parallel, then opens the gate for updates."""
+
+    global analysis_engine
+
+    loaders = [
+        startup.run('catalog', catalog.load),
+        startup.run('chart cache', chart_renderer.load),
+    ]
+    for app in apps:
+        loaders.extend(startup.run(name, func) for name, func in app.loaders())
+    has_history = os.path.isdir(HISTORY_DIR)
+    if has_history:
+        loaders.append(startup.run('analysis engine', create_analysis_engine))
+    try:
+        results = await asyncio.gather(*loaders)
+    except Exception as e:
+        # The bot cannot answer anything without its state
+        print(f"Error loading state at startup: {str(e)}")
+        asyncio.get_event_loop().stop()
+        return
+    if has_history:
+        analysis_engine = results[-1]
+    startup.set_ready()
+    print(startup.report())
+
+    catalog.start()
+    if analysis_engine is not None:
+        asyncio.ensure_future(refresh_analysis_periodically())
+    recommendation_log.start()
+    for app in apps:
+        app.start()
+    for feed in price_feeds:
+        await feed.start()
+
+
+async def on_startup(dispatchers):
+    """Starts warmup in the background so updates are accepted right away."""
+
+    if METRICS_PORT:
+        await start_metrics_server('0.0.0.0', METRICS_PORT)
+    asyncio.ensure_future(warmup())
+
+
+async def on_shutdown(dispatchers):
+    """Flushes in-memory state to disk and closes storage and the shared session."""
+
+    if startup.ready.is_set():
+        # Before warmup finished, saving could overwrite files with partial state
+        await catalog.close()
+        chart_renderer.close()
+        for feed in price_feeds:
+            await feed.close()
+        for app in apps:
+            await app.close()
+        await recommendation_log.close()
+    for app in apps:
+        await app.close_storage()
+    await session_pool.close()
+
+
 # Run the bot
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if WEBHOOK_URL:
+        from webhook import start_webhook
+        # The main bot keeps WEBHOOK_PATH, the others get a path of their own
+        routes = [(app.dp, WEBHOOK_PATH if app.name == MAIN_BOT_NAME else f"{WEBHOOK_PATH}/{app.name}")
+                  for app in apps]
+        start_webhook(routes, WEBHOOK_URL, WEBAPP_HOST, WEBAPP_PORT,
+                      workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+                      on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        run_polling([app.dp for app in apps], on_startup=on_startup, on_shutdown=on_shutdown)
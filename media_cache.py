@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+
+from metrics import metrics
+
+
+def image_version(image_path):
+    """Identifies the current contents of an image file by size and mtime."""
+
+    stat = os.stat(image_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+class MediaCache:
+    """Remembers Telegram file_ids of uploaded chart images.
+
+    Entries are keyed by (coin, timeframe) and store the image path and
+    version they were uploaded from, so a replaced image is never served
+    from a stale file_id.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(coin, timeframe):
+        return f"{coin}:{timeframe}"
+
+    def load(self):
+        """Loads persisted entries, dropping those whose image has changed."""
+
+        try:
+            with open(self.filename, 'r') as file:
+                entries = json.load(file)
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        self.entries = {}
+        for key, entry in entries.items():
+            try:
+                if image_version(entry['image']) == entry['version']:
+                    self.entries[key] = entry
+            except (OSError, KeyError):
+                pass
+        return self
+
+    def _current(self, coin, timeframe):
+        """Returns the entry of a coin and timeframe, dropping it if its image changed on disk."""
+
+        key = self._key(coin, timeframe)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            version = image_version(entry['image'])
+        except OSError:
+            version = None
+        if version != entry['version']:
+            del self.entries[key]
+            return None
+        return entry
+
+    def get(self, coin, timeframe, image_path):
+        """Returns the cached file_id for the current version of an image, or None."""
+
+        entry = self._current(coin, timeframe)
+        if entry is None or entry['image'] != image_path:
+            return None
+        return entry['file_id']
+
+    def latest(self, coin, timeframe):
+        """Returns the file_id of the last image uploaded for a coin and timeframe, or None.
+
+        Used where an image cannot be uploaded, such as inline query results.
+        """
+
+        entry = self._current(coin, timeframe)
+        return entry['file_id'] if entry is not None else None
+
+    def put(self, coin, timeframe, image_path, file_id):
+        """Records the file_id Telegram assigned to an uploaded image."""
+
+        try:
+            version = image_version(image_path)
+        except OSError:
+            return
+        self.entries[self._key(coin, timeframe)] = {
+            'image': image_path,
+            'version': version,
+            'file_id': file_id,
+        }
+
+    def invalidate(self, coin, timeframe):
+        """Forgets the file_id of an image that is being replaced."""
+
+        self.entries.pop(self._key(coin, timeframe), None)
+
+    def _write(self, entries):
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as file:
+            json.dump(entries, file)
+        os.replace(tmp_filename, self.filename)
+
+    def save(self):
+        """Writes the cache to disk via a temp file and rename."""
+
+        self._write(self.entries)
+
+    async def save_async(self):
+        """Writes the cache to disk from an executor thread."""
+
+        # Concurrent saves would share the temp file
+        async with self._lock:
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op='media_cache_save'):
+                    # A copy, the event loop keeps changing the entries meanwhile
+                    await loop.run_in_executor(None, self._write, dict(self.entries))
+            except OSError as e:
+                print(f"Error saving media cache: {str(e)}")
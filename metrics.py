@@ -0,0 +1,200 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed buckets."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket it falls in."""
+
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+
+class Metrics:
+    """Registry of histograms, counters and gauges."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func):
+        """Registers a callable whose value is read at scrape time."""
+
+        self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+
+        lines = []
+        for (name, key), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        for (name, key), value in sorted(self.counters.items()):
+            lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name, label, limit=10):
+        """Returns text lines with count, p50 and p95 per label value, slowest first."""
+
+        rows = []
+        for (metric, key), histogram in self.histograms.items():
+            if metric != name:
+                continue
+            value = dict(key).get(label, '')
+            rows.append((histogram.quantile(0.95), value, histogram))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return [
+            f"{value}: n={histogram.count} p50={histogram.quantile(0.5) * 1000:.0f}ms "
+            f"p95={p95 * 1000:.0f}ms"
+            for p95, value, histogram in rows[:limit]
+        ]
+
+
+metrics = Metrics()
+
+
+class InstrumentedBot(Bot):
+    """Bot that records the time spent in every Telegram API call."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - started,
+                            method=method)
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """Records per-handler latency and counts per callback_data."""
+
+    def _start(self, data):
+        data['_perf_started'] = time.perf_counter()
+        handler = current_handler.get(None)
+        data['_perf_handler'] = getattr(handler, '__name__', 'unknown')
+
+    def _finish(self, data):
+        started = data.get('_perf_started')
+        if started is not None:
+            metrics.observe('handler_seconds', time.perf_counter() - started,
+                            handler=data['_perf_handler'])
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finish(data)
+
+    async def on_pre_process_callback_query(self, callback_query, data):
+        metrics.inc('callback_queries_total', callback_data=callback_query.data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish(data)
+
+    async def on_process_inline_query(self, inline_query, data):
+        self._start(data)
+
+    async def on_post_process_inline_query(self, inline_query, results, data):
+        self._finish(data)
+
+
+def format_perf():
+    """Builds the /perf report for admins."""
+
+    sections = [
+        ("Handlers", metrics.summary('handler_seconds', 'handler')),
+        ("Telegram API", metrics.summary('telegram_api_seconds', 'method')),
+        ("Disk I/O", metrics.summary('disk_io_seconds', 'op')),
+        ("FSM storage", metrics.summary('fsm_storage_seconds', 'op')),
+    ]
+    text = []
+    for title, lines in sections:
+        text.append(f"{title}:\n" + ("\n".join(lines) if lines else "no data"))
+    gauges = [f"{name}: {func()}" for name, func in sorted(metrics.gauges.items())]
+    if gauges:
+        text.append("Gauges:\n" + "\n".join(gauges))
+    return "\n\n".join(text)
+
+
+async def start_metrics_server(host, port):
+    """Serves /metrics from a separate aiohttp server."""
+
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,98 @@
+import asyncio
+import os
+
+
+def parse_tick(line):
+    """Parses a "coin,price" line. Returns (coin, price) or None."""
+
+    parts = line.strip().split(',')
+    if len(parts) != 2:
+        return None
+    try:
+        return parts[0], float(parts[1])
+    except ValueError:
+        return None
+
+
+class FilePriceFeed:
+    """Follows a file of "coin,price" lines appended by an external process.
+
+    Only lines appended after the feed starts are reported. A truncated
+    or replaced file is read again from the start.
+    """
+
+    def __init__(self, filename, on_tick, poll_interval=0.5):
+        self.filename = filename
+        self.on_tick = on_tick
+        self.poll_interval = poll_interval
+        self.offset = None
+        self._task = None
+
+    def _read(self):
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            return []
+        if self.offset is None or size < self.offset:
+            self.offset = size if self.offset is None else 0
+        if size == self.offset:
+            return []
+        with open(self.filename, 'rb') as file:
+            file.seek(self.offset)
+            chunk = file.read(size - self.offset)
+        # Leave a trailing partial line for the next read
+        end = chunk.rfind(b'\n') + 1
+        self.offset += end
+        return chunk[:end].decode(errors='replace').splitlines()
+
+    async def _follow(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            for line in await loop.run_in_executor(None, self._read):
+                tick = parse_tick(line)
+                if tick is not None:
+                    self.on_tick(*tick)
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._follow())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class SocketPriceFeed:
+    """Accepts TCP connections that stream "coin,price" lines."""
+
+    def __init__(self, host, port, on_tick):
+        self.host = host
+        self.port = port
+        self.on_tick = on_tick
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tick = parse_tick(line.decode(errors='replace'))
+                if tick is not None:
+                    self.on_tick(*tick)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
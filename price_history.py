@@ -0,0 +1,246 @@
+import json
+import os
+import struct
+import time
+
+from media_cache import image_version
+
+# Fixed-width columns of each series, one file per column
+COLUMNS = {
+    'time': 'd',
+    'price': 'd',
+    'stop': 'd',
+    'take': 'd',
+    'image': 'I',  # Index into the series' image table
+}
+MANIFEST = 'catalog.json'
+
+
+def _signature(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Series:
+    """Append-only columns of one coin and timeframe.
+
+    Every catalog change appends a row (time, price, stop, take, image)
+    to the column files. Images are stored as indexes into images.txt,
+    whose lines are "<path>\\t<version>", so a new upload to the same path
+    is a new image version.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.rows = 0
+        self.last = None  # (price, stop, take, image index) of the last row
+        self.images = []
+        self._image_ids = {}
+        self._maps = None  # (rows, {column: np.memmap}) for queries
+
+    def _path(self, column):
+        return os.path.join(self.directory, f"{column}.{COLUMNS[column]}")
+
+    def open(self):
+        """Reads the row count, the last row and the image table.
+
+        Rows torn by an interrupted append are cut off every column, so
+        the columns stay aligned. Nothing else is read, so opening does
+        not depend on the length of the series.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        sizes = {column: struct.calcsize(code) for column, code in COLUMNS.items()}
+        lengths = {}
+        for column in COLUMNS:
+            try:
+                lengths[column] = os.path.getsize(self._path(column))
+            except FileNotFoundError:
+                lengths[column] = 0
+        self.rows = min(lengths[column] // size for column, size in sizes.items())
+        for column, size in sizes.items():
+            if lengths[column] != self.rows * size:
+                with open(self._path(column), 'ab') as file:
+                    file.truncate(self.rows * size)
+
+        try:
+            with open(os.path.join(self.directory, 'images.txt'), 'r') as file:
+                self.images = [tuple(line.rstrip('\n').split('\t', 1)) for line in file]
+        except FileNotFoundError:
+            self.images = []
+        self._image_ids = {image: index for index, image in enumerate(self.images)}
+
+        if self.rows:
+            row = {}
+            for column, size in sizes.items():
+                with open(self._path(column), 'rb') as file:
+                    file.seek((self.rows - 1) * size)
+                    row[column] = struct.unpack(f"<{COLUMNS[column]}", file.read(size))[0]
+            self.last = (row['price'], row['stop'], row['take'], row['image'])
+        return self
+
+    def image_id(self, path, version):
+        """Returns the index of an image version, adding it to the table if new."""
+
+        key = (path, version)
+        if key not in self._image_ids:
+            with open(os.path.join(self.directory, 'images.txt'), 'a') as file:
+                file.write(f"{path}\t{version}\n")
+            self._image_ids[key] = len(self.images)
+            self.images.append(key)
+        return self._image_ids[key]
+
+    def append(self, timestamp, price, stop, take, image):
+        """Appends one row to every column."""
+
+        values = {'time': timestamp, 'price': price, 'stop': stop, 'take': take, 'image': image}
+        for column, code in COLUMNS.items():
+            with open(self._path(column), 'ab') as file:
+                file.write(struct.pack(f"<{code}", values[column]))
+        self.rows += 1
+        self.last = (price, stop, take, image)
+
+    def columns(self):
+        """Returns {column: array} memory-mapped over the files, without copying."""
+
+        import numpy as np  # Only queries need NumPy, recording and bootstrapping do not
+
+        if self._maps is None or self._maps[0] != self.rows:
+            maps = {}
+            for column, code in COLUMNS.items():
+                dtype = np.dtype(f"<{code}")
+                maps[column] = (np.memmap(self._path(column), dtype=dtype, mode='r',
+                                          shape=(self.rows,))
+                                if self.rows else np.empty(0, dtype=dtype))
+            self._maps = (self.rows, maps)
+        return self._maps[1]
+
+
+class PriceHistory:
+    """Columnar history of the catalog's prices, stop/take levels and images.
+
+    Each coin and timeframe has a Series of fixed-width column files in
+    `directory`. The manifest keeps the coin order and the size and mtime
+    of the catalog CSV the history was last written with, so a catalog
+    whose CSV has not changed since is rebuilt from the last row of each
+    series instead of parsing the CSV.
+    """
+
+    def __init__(self, directory, timeframes):
+        self.directory = directory
+        self.timeframes = timeframes
+        self.series = {}
+        self.manifest = None
+
+    def _series(self, coin, timeframe):
+        key = (coin, timeframe)
+        if key not in self.series:
+            self.series[key] = Series(os.path.join(self.directory, coin, timeframe)).open()
+        return self.series[key]
+
+    def _read_manifest(self):
+        if self.manifest is None:
+            try:
+                with open(os.path.join(self.directory, MANIFEST), 'r') as file:
+                    self.manifest = json.load(file)
+            except (FileNotFoundError, ValueError):
+                self.manifest = {'coins': [], 'csv_signature': None}
+        return self.manifest
+
+    def _write_manifest(self, manifest):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, MANIFEST)
+        with open(f"{filename}.tmp", 'w') as file:
+            json.dump(manifest, file)
+        os.replace(f"{filename}.tmp", filename)
+        self.manifest = manifest
+
+    def matches(self, csv_file):
+        """Returns True if the history was last written together with `csv_file` as it is now."""
+
+        signature = self._read_manifest()['csv_signature']
+        return signature is not None and signature == _signature(csv_file)
+
+    def latest(self):
+        """Returns the catalog as of the last row of every series, or None if empty."""
+
+        crypto_data = {}
+        for coin in self._read_manifest()['coins']:
+            crypto_data[coin] = {}
+            for timeframe in self.timeframes:
+                series = self._series(coin, timeframe)
+                if series.last is None:
+                    return None
+                price, stop, take, image = series.last
+                crypto_data[coin][timeframe] = {
+                    'price': price, 'image': series.images[image][0], 'stop': stop, 'take': take}
+        return crypto_data or None
+
+    def record(self, crypto_data, csv_file, timestamp=None):
+        """Appends a row to every series whose values changed, then updates the manifest.
+
+        Called after the catalog CSV has been written. Blocking, runs in an
+        executor thread.
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+        for coin, timeframes in crypto_data.items():
+            for timeframe in self.timeframes:
+                entry = timeframes[timeframe]
+                series = self._series(coin, timeframe)
+                try:
+                    version = image_version(entry['image'])
+                except OSError:
+                    version = ''
+                image = series.image_id(entry['image'], version)
+                values = (float(entry['price']), float(entry['stop']), float(entry['take']), image)
+                if values != series.last:
+                    series.append(timestamp, *values)
+        manifest = {'coins': list(crypto_data), 'csv_signature': _signature(csv_file)}
+        if manifest != self._read_manifest():
+            self._write_manifest(manifest)
+
+    def range(self, coin, timeframe, start=None, end=None):
+        """Returns the rows of a series with start <= time < end as memory-mapped views."""
+
+        columns = self._series(coin, timeframe).columns()
+        times = columns['time']
+        first = 0 if start is None else int(times.searchsorted(start, 'left'))
+        last = len(times) if end is None else int(times.searchsorted(end, 'left'))
+        return {column: values[first:last] for column, values in columns.items()}
+
+    def as_of(self, coin, timeframe, timestamp):
+        """Returns the catalog entry of a coin and timeframe as it was at `timestamp`, or None."""
+
+        series = self._series(coin, timeframe)
+        columns = series.columns()
+        index = int(columns['time'].searchsorted(timestamp, 'right')) - 1
+        if index < 0:
+            return None
+        path, version = series.images[int(columns['image'][index])]
+        return {
+            'time': float(columns['time'][index]),
+            'price': float(columns['price'][index]),
+            'stop': float(columns['stop'][index]),
+            'take': float(columns['take'][index]),
+            'image': path,
+            'image_version': version,
+        }
+
+
+def format_price_history(coin, timeframe, rows, limit=10):
+    """Formats the last `limit` rows of a range query for the /price_history command."""
+
+    lines = [f"{coin} ({timeframe}): {len(rows['time'])} changes"]
+    first = max(0, len(rows['time']) - limit)
+    for index in range(first, len(rows['time'])):
+        changed = index > 0 and rows['image'][index] != rows['image'][index - 1]
+        lines.append(
+            f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(float(rows['time'][index])))} UTC: "
+            f"{float(rows['price'][index])} $, stop {float(rows['stop'][index])}%, "
+            f"take {float(rows['take'][index])}%" + (", new image" if changed else ""))
+    return "\n".join(lines)
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import struct
+import time
+
+from catalog import TIMEFRAMES
+from metrics import metrics
+
+# time, timeframe index, entry price, stop %, take %; packed little-endian
+RECORD = struct.Struct('<dBdff')
+
+
+class RecommendationLog:
+    """Append-only log of the entry zones and stop/take levels sent to users.
+
+    Each coin has a file of fixed-width binary records in `directory`, so
+    the backtester can read millions of them with one np.fromfile() call.
+    Records are buffered and appended every `flush_interval` seconds.
+    """
+
+    def __init__(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._buffer = {}  # coin -> [packed records]
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def filename(self, coin):
+        return os.path.join(self.directory, f"{coin}.bin")
+
+    def record(self, coin, timeframe, entry, timestamp=None):
+        """Records a recommendation made from a catalog entry (price, stop, take)."""
+
+        if timestamp is None:
+            timestamp = time.time()
+        self._buffer.setdefault(coin, []).append(RECORD.pack(
+            timestamp, TIMEFRAMES.index(timeframe), entry['price'], entry['stop'], entry['take']))
+
+    def _append(self, buffer):
+        os.makedirs(self.directory, exist_ok=True)
+        for coin, records in buffer.items():
+            with open(self.filename(coin), 'ab') as file:
+                file.write(b''.join(records))
+
+    async def flush(self):
+        """Appends buffered records from an executor thread."""
+
+        async with self._lock:
+            if not self._buffer:
+                return
+            buffer, self._buffer = self._buffer, {}
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op='recommendations_flush'):
+                    await loop.run_in_executor(None, self._append, buffer)
+            except OSError as e:
+                for coin, records in buffer.items():  # Retry on the next flush
+                    self._buffer[coin] = records + self._buffer.get(coin, [])
+                print(f"Error writing recommendations: {str(e)}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Starts the background flush task."""
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        """Stops the background task and flushes buffered records."""
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
@@ -0,0 +1,143 @@
+import json
+
+from aiogram import types
+
+from catalog import TIMEFRAMES
+
+# Coins per page of the coin picker
+COINS_PAGE_SIZE = 10
+
+CAPTION_TEMPLATE = (
+    "Cудя по анализу за последние недели, лучшая зона для покупок {coin} ({timeframe}) это зона : {price} $"
+    "\n\n\nМожно поставить от этой цены стоп-лосс {stop:g}%, и тейк {take:g}%"
+)
+
+
+def serialize(keyboard):
+    """Serialises a keyboard to the JSON string Telegram expects.
+
+    aiogram sends string reply_markup values unchanged, so a keyboard
+    serialised once can be reused for every request.
+    """
+
+    return json.dumps(keyboard.to_python())
+
+
+def build_go_back_keyboard():
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton("Go Back", callback_data="go_back"))
+    return keyboard
+
+
+def build_role_keyboard(is_admin):
+    keyboard = types.InlineKeyboardMarkup()
+    buttons = [types.InlineKeyboardButton("User", callback_data="user")]
+    if is_admin:
+        buttons.insert(0, types.InlineKeyboardButton("Admin", callback_data="admin"))
+    keyboard.row(*buttons)
+    return keyboard
+
+
+def build_timeframe_keyboard(include_all=False):
+    keyboard = types.InlineKeyboardMarkup()
+    for timeframe in ["Day", "Week", "Month"]:
+        keyboard.row(types.InlineKeyboardButton(
+            timeframe, callback_data=timeframe.lower()))
+    if include_all:
+        keyboard.row(types.InlineKeyboardButton("All timeframes", callback_data="all"))
+    keyboard.row(types.InlineKeyboardButton("Go Back", callback_data="go_back"))
+    return keyboard
+
+
+def build_coins_keyboard(coins, page, page_count):
+    """Builds one page of the coin picker, two coins per row."""
+
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*[types.InlineKeyboardButton(coin, callback_data=coin) for coin in coins])
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton(
+            f"◀ {page}/{page_count}", callback_data=f"coins_page:{page - 1}"))
+    if page < page_count - 1:
+        navigation.append(types.InlineKeyboardButton(
+            f"{page + 2}/{page_count} ▶", callback_data=f"coins_page:{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.row(types.InlineKeyboardButton("Go Back", callback_data="go_back"))
+    return keyboard
+
+
+def build_coins_pages(crypto_data, page_size=COINS_PAGE_SIZE):
+    coins = list(crypto_data)
+    page_count = max(1, -(-len(coins) // page_size))
+    return [build_coins_keyboard(coins[page * page_size:(page + 1) * page_size],
+                                 page, page_count)
+            for page in range(page_count)]
+
+
+def build_result_keyboard(coin, timeframe):
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton(
+        "🔔 Alert me at the entry zone", callback_data=f"alert:{coin}:{timeframe}"))
+    keyboard.add(types.InlineKeyboardButton("Go Back", callback_data="go_back"))
+    return keyboard
+
+
+def build_caption(coin, timeframe, entry):
+    return CAPTION_TEMPLATE.format(coin=coin, timeframe=timeframe, price=entry['price'],
+                                   stop=entry['stop'], take=entry['take'])
+
+
+class RenderCache:
+    """Pre-rendered keyboards and captions for the current catalog version.
+
+    Keyboards are stored already serialised. Everything that depends on the
+    catalog is rebuilt when a new catalog snapshot is published.
+    """
+
+    def __init__(self):
+        self.go_back_keyboard = serialize(build_go_back_keyboard())
+        self.admin_role_keyboard = serialize(build_role_keyboard(True))
+        self.user_role_keyboard = serialize(build_role_keyboard(False))
+        self.timeframe_keyboard = serialize(build_timeframe_keyboard())
+        self.user_timeframe_keyboard = serialize(build_timeframe_keyboard(include_all=True))
+        self.version = None
+        self.coins_pages = []
+        self.captions = {}
+        self.result_keyboards = {}
+
+    def rebuild(self, snapshot):
+        """Renders everything that depends on a catalog snapshot."""
+
+        captions = {}
+        result_keyboards = {}
+        for coin, timeframes in snapshot.data.items():
+            for timeframe in TIMEFRAMES:
+                captions[(coin, timeframe)] = build_caption(
+                    coin, timeframe, timeframes[timeframe])
+                result_keyboards[(coin, timeframe)] = serialize(
+                    build_result_keyboard(coin, timeframe))
+        self.coins_pages = [serialize(page) for page in build_coins_pages(snapshot.data)]
+        self.captions = captions
+        self.result_keyboards = result_keyboards
+        self.version = snapshot.version
+
+    @property
+    def coins_keyboard(self):
+        return self.coins_pages[0]
+
+    def coins_page(self, page):
+        """Returns a page of the coin picker, or None past the last page."""
+
+        if 0 <= page < len(self.coins_pages):
+            return self.coins_pages[page]
+        return None
+
+    def role_keyboard(self, is_admin):
+        return self.admin_role_keyboard if is_admin else self.user_role_keyboard
+
+    def caption(self, coin, timeframe):
+        return self.captions[(coin, timeframe)]
+
+    def result_keyboard(self, coin, timeframe):
+        return self.result_keyboards[(coin, timeframe)]
@@ -0,0 +1,198 @@
+import asyncio
+import collections
+import os
+import time
+
+from metrics import metrics
+
+BUCKET_SECONDS = 60 * 60  # Rollups are kept per hour
+
+# Sliding windows reported by /stats, in buckets
+WINDOWS = {
+    '24h': 24,
+    '7d': 7 * 24,
+    '30d': 30 * 24,
+}
+RETENTION_BUCKETS = max(WINDOWS.values())
+
+
+def _event_keys(coin, timeframe):
+    return ('total', f"coin:{coin}", f"timeframe:{timeframe}")
+
+
+class RequestLog:
+    """Append-only log of analysis requests with hourly sliding-window rollups.
+
+    Every request is appended to a CSV log (timestamp,user_id,coin,timeframe)
+    and counted in an hourly bucket. Each window keeps a running sum, so
+    reading it never scans events or buckets. Buckets older than the longest
+    window are dropped, and the log file is compacted to the same retention.
+    """
+
+    def __init__(self, filename, flush_interval=5.0, compact_interval=6 * 60 * 60):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.buckets = collections.OrderedDict()
+        self.window_sums = {window: collections.Counter() for window in WINDOWS}
+        self.window_start = {window: None for window in WINDOWS}
+        self._buffer = []
+        self._lock = asyncio.Lock()
+        self._tasks = []
+
+    def load(self):
+        """Rebuilds the rollups from the events still within retention."""
+
+        cutoff = time.time() - RETENTION_BUCKETS * BUCKET_SECONDS
+        try:
+            with open(self.filename, 'r') as file:
+                for line in file:
+                    parts = line.rstrip('\n').split(',')
+                    if len(parts) != 4:
+                        continue  # Skip a torn line left by an interrupted append
+                    try:
+                        timestamp = float(parts[0])
+                    except ValueError:
+                        continue
+                    if timestamp >= cutoff:
+                        self._count(timestamp, parts[2], parts[3])
+        except FileNotFoundError:
+            pass
+        return self
+
+    def _advance(self, current):
+        """Moves every window so that it ends at bucket `current`."""
+
+        for window, length in WINDOWS.items():
+            new_start = current - length + 1
+            old_start = self.window_start[window]
+            if old_start is None or new_start - old_start >= length:
+                # Nothing in the old window survives, rebuild it
+                self.window_sums[window] = collections.Counter()
+                for index, counter in self.buckets.items():
+                    if new_start <= index <= current:
+                        self.window_sums[window].update(counter)
+            elif new_start > old_start:
+                for index in range(old_start, new_start):
+                    counter = self.buckets.get(index)
+                    if counter:
+                        self.window_sums[window].subtract(counter)
+            if old_start is None or new_start > old_start:
+                self.window_start[window] = new_start
+
+        while self.buckets and next(iter(self.buckets)) <= current - RETENTION_BUCKETS:
+            self.buckets.popitem(last=False)
+
+    def _count(self, timestamp, coin, timeframe):
+        index = int(timestamp // BUCKET_SECONDS)
+        self._advance(max(index, self._current_index()))
+        keys = _event_keys(coin, timeframe)
+        counter = self.buckets.get(index)
+        if counter is None:
+            counter = self.buckets[index] = collections.Counter()
+        counter.update(keys)
+        for window in WINDOWS:
+            if index >= self.window_start[window]:
+                self.window_sums[window].update(keys)
+
+    def _current_index(self):
+        latest = next(reversed(self.buckets)) if self.buckets else 0
+        return max(latest, int(time.time() // BUCKET_SECONDS))
+
+    def record(self, user_id, coin, timeframe, timestamp=None):
+        """Records one analysis request."""
+
+        if timestamp is None:
+            timestamp = time.time()
+        self._count(timestamp, coin, timeframe)
+        self._buffer.append(f"{timestamp:.3f},{user_id},{coin},{timeframe}\n")
+
+    def count(self, window, key='total'):
+        """Returns the number of requests in `window` for `key`.
+
+        `key` is 'total', 'coin:<coin>' or 'timeframe:<timeframe>'.
+        """
+
+        self._advance(self._current_index())
+        return self.window_sums[window][key]
+
+    def breakdown(self, window, kind):
+        """Returns {name: count} of requests in `window` by 'coin' or 'timeframe'."""
+
+        self._advance(self._current_index())
+        prefix = f"{kind}:"
+        return {key[len(prefix):]: value
+                for key, value in self.window_sums[window].items()
+                if key.startswith(prefix) and value > 0}
+
+    def _append(self, lines):
+        with open(self.filename, 'a') as file:
+            file.writelines(lines)
+
+    def _rewrite(self, cutoff):
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(self.filename, 'r') as src, open(tmp_filename, 'w') as dst:
+                for line in src:
+                    try:
+                        if float(line.split(',', 1)[0]) >= cutoff:
+                            dst.write(line)
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            return
+        os.replace(tmp_filename, self.filename)
+
+    async def flush(self):
+        """Appends buffered events to the log from an executor thread."""
+
+        async with self._lock:
+            if not self._buffer:
+                return
+            lines, self._buffer = self._buffer, []
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op='request_log_flush'):
+                    await loop.run_in_executor(None, self._append, lines)
+            except OSError as e:
+                self._buffer = lines + self._buffer  # Retry on the next flush
+                print(f"Error writing request log: {str(e)}")
+
+    async def compact(self):
+        """Drops events older than the retention period from the log file."""
+
+        await self.flush()
+        async with self._lock:
+            cutoff = time.time() - RETENTION_BUCKETS * BUCKET_SECONDS
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op='request_log_compact'):
+                    await loop.run_in_executor(None, self._rewrite, cutoff)
+            except OSError as e:
+                print(f"Error compacting request log: {str(e)}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _compact_periodically(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            await self.compact()
+
+    def start(self):
+        """Starts the background flush and compaction tasks."""
+
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._flush_periodically()),
+                           asyncio.ensure_future(self._compact_periodically())]
+
+    async def close(self):
+        """Stops the background tasks and flushes buffered events."""
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+class StartupTimer:
+    """Records how long each startup phase took and when the bot became ready.
+
+    `started` is a time.perf_counter() value taken before the imports of
+    main.py, so they are part of the report.
+    """
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self._last_mark = self.started
+        self.phases = []
+        self.ready_after = None
+        self.ready = asyncio.Event()
+
+    def mark(self, name):
+        """Records a phase that began at the previous mark and ended now."""
+
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last_mark))
+        self._last_mark = now
+
+    async def run(self, name, func, *args):
+        """Runs a blocking loader in an executor thread and records its duration.
+
+        Loaders run concurrently, so their durations overlap.
+        """
+
+        loop = asyncio.get_event_loop()
+        started = time.perf_counter()
+        result = await loop.run_in_executor(None, func, *args)
+        self.phases.append((name, time.perf_counter() - started))
+        return result
+
+    def set_ready(self):
+        self.ready_after = time.perf_counter() - self.started
+        self.ready.set()
+
+    def report(self):
+        """Returns the startup breakdown as text."""
+
+        lines = [f"{name}: {seconds * 1000:.0f}ms" for name, seconds in self.phases]
+        if self.ready_after is not None:
+            lines.append(f"Ready after {self.ready_after * 1000:.0f}ms")
+        return "Startup:\n" + "\n".join(lines)
+
+
+class ReadinessMiddleware(BaseMiddleware):
+    """Holds updates that arrive during warmup until the bot is ready."""
+
+    def __init__(self, timer):
+        super().__init__()
+        self.timer = timer
+
+    async def on_pre_process_update(self, update, data):
+        if not self.timer.ready.is_set():
+            await self.timer.ready.wait()
@@ -0,0 +1,108 @@
+import asyncio
+import csv
+import os
+
+from metrics import metrics
+
+# Define fieldnames for the user statistics CSV file. Windowed counts
+# (24h, 7d, 30d) come from the RequestLog rollups, only the all-time total
+# is kept here; older files with day/week/month columns are still read.
+USER_STATS_FIELDNAMES = ['total']
+
+
+def read_user_stats(filename):
+    """Reads user statistics from a CSV file."""
+
+    user_stats = {
+        'total': 0,
+    }
+    try:
+        with open(filename, 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                user_stats['total'] = int(row['total'])
+    except FileNotFoundError:
+        pass  # If the file doesn't exist, start with default values
+    return user_stats
+
+
+def write_user_stats(filename, user_stats):
+    """Writes user statistics to a CSV file via a temp file and rename."""
+
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=USER_STATS_FIELDNAMES)
+        writer.writeheader()
+        writer.writerow(user_stats)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(tmp_filename, filename)
+
+
+class StatsSink:
+    """Counts all-time requests in memory and flushes them to disk in the background."""
+
+    def __init__(self, filename, flush_interval=5.0, flush_threshold=100):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.stats = None
+        self._pending = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def load(self):
+        """Reads the counters from disk."""
+
+        self.stats = read_user_stats(self.filename)
+        return self
+
+    def increment(self, count=1):
+        """Records `count` analysis requests."""
+
+        self.stats['total'] += count
+
+        self._pending += count
+        if self._pending >= self.flush_threshold:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Writes the current counters to disk from an executor thread."""
+
+        async with self._lock:
+            if not self._pending:
+                return
+            snapshot = dict(self.stats)
+            pending = self._pending
+            self._pending = 0
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op='stats_flush'):
+                    await loop.run_in_executor(None, write_user_stats,
+                                               self.filename, snapshot)
+            except OSError as e:
+                self._pending += pending  # Retry on the next flush
+                print(f"Error writing user statistics: {str(e)}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Starts the background flush task."""
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        """Stops the background task and performs the final flush."""
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils import exceptions
+
+from metrics import metrics
+
+
+class UserBuckets:
+    """Non-blocking token buckets, one per user."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}  # user_id -> (tokens, updated)
+
+    def consume(self, user_id):
+        """Takes a token from the user's bucket. Returns False if it is empty."""
+
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self.buckets) > 10000:
+            # Drop users whose bucket has refilled, they are back at the default
+            full_after = self.capacity / self.rate
+            self.buckets = {user: state for user, state in self.buckets.items()
+                            if now - state[1] < full_after}
+        return allowed
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Keeps bursts of button taps from reaching the callback handlers.
+
+    Every callback query is acknowledged right away so the client stops
+    its spinner and retries. Then, in order:
+    - taps beyond a per-user token bucket (`rate` per second, bursts of
+      `burst`) are dropped;
+    - a tap on the same button of the same message while the previous one
+      is still being handled is dropped;
+    - a tap repeated within `replay_window` seconds of a handler that
+      returned the message it sent is answered with a copy of that message.
+    Users in `exempt_user_ids`, such as admins, are only acknowledged.
+    """
+
+    def __init__(self, rate=2.0, burst=5, replay_window=10.0, exempt_user_ids=()):
+        super().__init__()
+        self.exempt_user_ids = set(exempt_user_ids)
+        self.buckets = UserBuckets(rate, burst)
+        self.replay_window = replay_window
+        self.in_flight = set()
+        self.responses = {}  # key -> (time, sent message)
+
+    @staticmethod
+    def _key(callback_query):
+        if callback_query.message is not None:
+            origin = (callback_query.message.chat.id, callback_query.message.message_id)
+        else:
+            origin = callback_query.inline_message_id
+        return callback_query.from_user.id, origin, callback_query.data
+
+    async def _acknowledge(self, callback_query):
+        try:
+            await callback_query.answer()
+        except exceptions.TelegramAPIError as e:
+            print(f"Error answering callback query: {str(e)}")
+
+    async def _replay(self, callback_query, sent):
+        try:
+            await callback_query.bot.copy_message(
+                callback_query.from_user.id, sent.chat.id, sent.message_id,
+                reply_markup=sent.reply_markup)
+        except exceptions.TelegramAPIError as e:
+            print(f"Error replaying response: {str(e)}")
+
+    async def on_pre_process_callback_query(self, callback_query, data):
+        asyncio.ensure_future(self._acknowledge(callback_query))
+        if callback_query.from_user.id in self.exempt_user_ids:
+            return
+
+        if not self.buckets.consume(callback_query.from_user.id):
+            metrics.inc('callbacks_throttled_total', reason='rate')
+            raise CancelHandler()
+
+        key = self._key(callback_query)
+        if key in self.in_flight:
+            metrics.inc('callbacks_throttled_total', reason='in_flight')
+            raise CancelHandler()
+
+        response = self.responses.get(key)
+        if response is not None:
+            sent_at, sent = response
+            if time.monotonic() - sent_at < self.replay_window:
+                metrics.inc('callbacks_throttled_total', reason='replay')
+                await self._replay(callback_query, sent)
+                raise CancelHandler()
+            del self.responses[key]
+
+        self.in_flight.add(key)
+        data['_throttling_key'] = key
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        key = data.get('_throttling_key')
+        if key is None:
+            return
+        self.in_flight.discard(key)
+        sent = [result for result in results if isinstance(result, types.Message)]
+        if sent:
+            now = time.monotonic()
+            self.responses[key] = (now, sent[-1])
+            if len(self.responses) > 10000:
+                self.responses = {k: v for k, v in self.responses.items()
+                                  if now - v[0] < self.replay_window}
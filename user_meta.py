@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import json
+import os
+import time
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from metrics import metrics
+
+DAY_SECONDS = 24 * 60 * 60
+# Outcomes after which a user can no longer receive messages
+DEAD_OUTCOMES = {'blocked', 'deactivated', 'not_found'}
+# Other failures in a row after which a user is treated as unreachable
+MAX_FAILURES = 5
+
+
+def _new_record():
+    return {'last_seen': None, 'language': None, 'interests': [],
+            'failures': 0, 'dead': False}
+
+
+class UserMetaStore:
+    """Per-user metadata with precomputed audience indexes.
+
+    Keeps last-seen time, language, coins the user asked about and
+    delivery failures. Users are indexed by last-seen day, language and
+    coin, and unreachable users are kept in a set, so selecting a segment
+    never scans all users.
+
+    Changed records are appended to a JSON-lines file every
+    `flush_interval` seconds, the last line of a user wins on load, and
+    the file is rewritten once it holds `compact_ratio` times more lines
+    than users.
+    """
+
+    def __init__(self, filename, flush_interval=5.0, compact_ratio=3):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.compact_ratio = compact_ratio
+        self.users = {}
+        self.by_day = collections.defaultdict(set)
+        self.by_language = collections.defaultdict(set)
+        self.by_coin = collections.defaultdict(set)
+        self.dead = set()
+        self._dirty = set()
+        self._lines = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def load(self):
+        """Replays the metadata file and builds the indexes."""
+
+        try:
+            with open(self.filename, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Skip a torn line left by an interrupted append
+                    self._lines += 1
+                    user_id = record.pop('id')
+                    self._unindex(user_id)
+                    self.users[user_id] = dict(_new_record(), **record)
+                    self._index(user_id)
+        except FileNotFoundError:
+            pass
+        return self
+
+    # Indexes
+
+    def _index(self, user_id):
+        record = self.users[user_id]
+        if record['last_seen'] is not None:
+            self.by_day[int(record['last_seen'] // DAY_SECONDS)].add(user_id)
+        if record['language']:
+            self.by_language[record['language']].add(user_id)
+        for coin in record['interests']:
+            self.by_coin[coin].add(user_id)
+        if record['dead']:
+            self.dead.add(user_id)
+
+    def _unindex(self, user_id):
+        record = self.users.get(user_id)
+        if record is None:
+            return
+        if record['last_seen'] is not None:
+            day = int(record['last_seen'] // DAY_SECONDS)
+            self.by_day[day].discard(user_id)
+            if not self.by_day[day]:
+                del self.by_day[day]
+        if record['language']:
+            self.by_language[record['language']].discard(user_id)
+        for coin in record['interests']:
+            self.by_coin[coin].discard(user_id)
+        self.dead.discard(user_id)
+
+    def _update(self, user_id, **fields):
+        record = self.users.get(user_id) or _new_record()
+        if all(record.get(field) == value for field, value in fields.items()) \
+                and user_id in self.users:
+            return
+        self._unindex(user_id)
+        record.update(fields)
+        self.users[user_id] = record
+        self._index(user_id)
+        self._dirty.add(user_id)
+
+    # Recording
+
+    def seen(self, user_id, language=None, timestamp=None):
+        """Records that a user interacted with the bot, which also revives them."""
+
+        if timestamp is None:
+            timestamp = time.time()
+        record = self.users.get(user_id)
+        fields = {'failures': 0, 'dead': False}
+        # Day granularity is all the indexes need, finer updates are not saved
+        if record is None or record['last_seen'] is None \
+                or int(record['last_seen'] // DAY_SECONDS) != int(timestamp // DAY_SECONDS):
+            fields['last_seen'] = timestamp
+        else:
+            record['last_seen'] = timestamp  # Saved with the next change of the record
+        if language:
+            fields['language'] = language
+        self._update(user_id, **fields)
+
+    def add_interest(self, user_id, coin):
+        """Records that a user asked about a coin."""
+
+        record = self.users.get(user_id)
+        interests = record['interests'] if record else []
+        if coin not in interests:
+            self._update(user_id, interests=interests + [coin])
+
+    def record_delivery(self, user_id, outcome):
+        """Updates delivery failures from a send outcome."""
+
+        record = self.users.get(user_id)
+        if outcome == 'sent':
+            if record is not None and (record['failures'] or record['dead']):
+                self._update(user_id, failures=0, dead=False)
+        elif outcome in DEAD_OUTCOMES:
+            self._update(user_id, dead=True)
+        else:
+            failures = (record['failures'] if record else 0) + 1
+            self._update(user_id, failures=failures, dead=failures >= MAX_FAILURES)
+
+    # Segments
+
+    def deliverable(self, user_ids):
+        """Returns `user_ids` without unreachable users, in the same order."""
+
+        return [user_id for user_id in user_ids if user_id not in self.dead]
+
+    def segment(self, term):
+        """Returns the set of user IDs in a segment.
+
+        Terms are 'active:<N>d' (seen in the last N days), 'coin:<coin>'
+        (asked about the coin) and 'lang:<code>'. Raises ValueError for an
+        unknown term.
+        """
+
+        kind, _, value = term.partition(':')
+        if kind == 'active' and value.endswith('d') and value[:-1].isdigit():
+            today = int(time.time() // DAY_SECONDS)
+            days = int(value[:-1])
+            users = set()
+            for day in range(today - days + 1, today + 1):
+                users |= self.by_day.get(day, set())
+            return users
+        if kind == 'coin' and value:
+            return set(self.by_coin.get(value, set()))
+        if kind == 'lang' and value:
+            return set(self.by_language.get(value, set()))
+        raise ValueError(f"Unknown segment {term!r}, use active:7d, coin:<coin> or lang:<code>")
+
+    def select(self, terms):
+        """Returns the deliverable users that are in every segment of `terms`."""
+
+        selected = self.segment(terms[0])
+        for term in terms[1:]:
+            selected &= self.segment(term)
+        return sorted(selected - self.dead)
+
+    # Persistence
+
+    def _append(self, lines):
+        with open(self.filename, 'a') as file:
+            file.writelines(lines)
+
+    def _rewrite(self, lines):
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as file:
+            file.writelines(lines)
+        os.replace(tmp_filename, self.filename)
+
+    def _line(self, user_id):
+        return json.dumps(dict(self.users[user_id], id=user_id)) + "\n"
+
+    async def flush(self):
+        """Appends changed records from an executor thread, compacting the file when due."""
+
+        async with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            compact = self._lines + len(dirty) > self.compact_ratio * max(len(self.users), 1000)
+            if compact:
+                lines = [self._line(user_id) for user_id in self.users]
+                write, op = self._rewrite, 'user_meta_compact'
+            else:
+                lines = [self._line(user_id) for user_id in dirty]
+                write, op = self._append, 'user_meta_flush'
+            loop = asyncio.get_event_loop()
+            try:
+                with metrics.timer('disk_io_seconds', op=op):
+                    await loop.run_in_executor(None, write, lines)
+            except OSError as e:
+                self._dirty |= dirty  # Retry on the next flush
+                print(f"Error writing user metadata: {str(e)}")
+                return
+            self._lines = len(lines) if compact else self._lines + len(lines)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Starts the background flush task."""
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        """Stops the background task and flushes pending changes."""
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+class UserMetaMiddleware(BaseMiddleware):
+    """Records last-seen time and language of everyone who talks to the bot."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def _seen(self, user):
+        if user is not None:
+            self.store.seen(user.id, user.language_code)
+
+    async def on_pre_process_message(self, message, data):
+        self._seen(message.from_user)
+
+    async def on_pre_process_callback_query(self, callback_query, data):
+        self._seen(callback_query.from_user)
+
+    async def on_pre_process_inline_query(self, inline_query, data):
+        self._seen(inline_query.from_user)
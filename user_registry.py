@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+from metrics import metrics
+
+
+class UserRegistry:
+    """Keeps the set of known user IDs in memory, backed by an append-only file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.user_ids = set()
+        self._order = []
+        self._appended = 0
+
+    def load(self):
+        """Loads user IDs from the text file once at startup."""
+
+        self.user_ids = set()
+        self._order = []
+        self._appended = 0
+        try:
+            with open(self.filename, 'r') as file:
+                content = file.read()
+        except FileNotFoundError:
+            content = ''  # If the file doesn't exist, start with an empty registry
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                user_id = int(line)
+            except ValueError:
+                continue  # Skip a torn line left by an interrupted append
+            if user_id in self.user_ids:
+                self._appended += 1  # Duplicate, will be dropped on compaction
+                continue
+            self.user_ids.add(user_id)
+            self._order.append(user_id)
+        if content and not content.endswith('\n'):
+            # Appends must start on a fresh line
+            self.compact()
+        return self
+
+    def __contains__(self, user_id):
+        return user_id in self.user_ids
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return iter(list(self._order))
+
+    def add(self, user_id):
+        """Adds a user ID, appending it to the file. Returns True if it was new."""
+
+        if user_id in self.user_ids:
+            return False
+        self.user_ids.add(user_id)
+        self._order.append(user_id)
+        with open(self.filename, 'a') as file:
+            file.write(f"{user_id}\n")
+        self._appended += 1
+        return True
+
+    def needs_compaction(self, threshold=1000):
+        """Tells whether enough appends have accumulated to rewrite the file."""
+
+        return self._appended >= threshold
+
+    def compact(self):
+        """Rewrites the file from the in-memory index, atomically."""
+
+        tmp_filename = f"{self.filename}.tmp"
+        _write_ids(tmp_filename, self._order)
+        os.replace(tmp_filename, self.filename)
+        self._appended = 0
+
+    async def compact_async(self):
+        """Compacts the file without blocking the event loop.
+
+        The bulk rewrite runs in an executor thread. IDs added while it runs
+        are appended to the new file before it replaces the old one.
+        """
+
+        loop = asyncio.get_event_loop()
+        tmp_filename = f"{self.filename}.tmp"
+        snapshot = list(self._order)
+        with metrics.timer('disk_io_seconds', op='user_ids_compact'):
+            await loop.run_in_executor(None, _write_ids, tmp_filename, snapshot)
+        with open(tmp_filename, 'a') as file:
+            for user_id in self._order[len(snapshot):]:
+                file.write(f"{user_id}\n")
+        os.replace(tmp_filename, self.filename)
+        self._appended = 0
+
+
+def _write_ids(filename, user_ids):
+    """Writes user IDs to a text file and syncs it to disk."""
+
+    with open(filename, 'w') as file:
+        for user_id in user_ids:
+            file.write(f"{user_id}\n")
+        file.flush()
+        os.fsync(file.fileno())
@@ -0,0 +1,158 @@
+import asyncio
+import hmac
+import secrets
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from metrics import metrics
+
+# Update fields that carry a chat, in the order they are checked
+CHAT_FIELDS = ['message', 'edited_message', 'channel_post', 'edited_channel_post',
+               'callback_query', 'inline_query', 'chosen_inline_result',
+               'shipping_query', 'pre_checkout_query', 'my_chat_member',
+               'chat_member', 'chat_join_request']
+# Telegram sends the secret_token given to setWebhook in this header
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_chat_id(data):
+    """Finds the chat (or user) an update belongs to, for sharding."""
+
+    for field in CHAT_FIELDS:
+        obj = data.get(field)
+        if not obj:
+            continue
+        chat = obj.get('chat') or (obj.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        sender = obj.get('from')
+        if sender:
+            return sender['id']
+    return 0
+
+
+class UpdatePipeline:
+    """Feeds webhook updates to worker coroutines through bounded queues.
+
+    Updates are sharded by chat_id, so each chat is always handled by the
+    same worker and its updates are processed in order. Only requests
+    carrying `secret_token`, which is registered with the webhook, are
+    accepted.
+    """
+
+    def __init__(self, dp, workers=8, queue_size=1000):
+        self.dp = dp
+        self.secret_token = secrets.token_urlsafe(32)
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers))
+                       for _ in range(workers)]
+        self._workers = []
+        self.accepting = False
+
+    def depth(self):
+        """Returns the number of updates waiting in all queues."""
+
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def put(self, data):
+        """Queues a raw update, waiting if its shard is full."""
+
+        shard = update_chat_id(data) % len(self.queues)
+        await self.queues[shard].put(data)
+
+    async def _work(self, queue):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            data = await queue.get()
+            try:
+                if data is None:
+                    return
+                # Each update gets its own task, and so its own context:
+                # aiogram caches the FSM state in context variables
+                await asyncio.ensure_future(
+                    self.dp.process_update(types.Update(**data)))
+            except Exception as e:
+                print(f"Error processing update: {str(e)}")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        self._workers = [asyncio.ensure_future(self._work(queue))
+                         for queue in self.queues]
+        self.accepting = True
+
+    async def drain(self):
+        """Stops accepting updates and waits until the queued ones are handled."""
+
+        self.accepting = False
+        for queue in self.queues:
+            await queue.put(None)
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def create_app(pipelines):
+    """Builds the aiohttp application that receives webhook updates.
+
+    `pipelines` maps each webhook path to the pipeline of its bot.
+    """
+
+    def handler(pipeline):
+        async def handle(request):
+            # Anyone can POST to the webhook path, only Telegram knows the secret
+            if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''),
+                                       pipeline.secret_token):
+                return web.Response(status=403)
+            if not pipeline.accepting:
+                # Telegram retries the update later
+                return web.Response(status=503)
+            try:
+                data = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            await pipeline.put(data)
+            return web.Response()
+        return handle
+
+    app = web.Application()
+    for path, pipeline in pipelines.items():
+        app.router.add_post(path, handler(pipeline))
+    return app
+
+
+def start_webhook(routes, webhook_url, host, port, workers, queue_size,
+                  on_startup=None, on_shutdown=None):
+    """Serves bots through webhooks until SIGINT or SIGTERM.
+
+    `routes` is a list of (dispatcher, path), one per bot. Callbacks get
+    the list of dispatchers and `on_shutdown` is expected to close their
+    storage and sessions.
+    """
+
+    dispatchers = [dp for dp, _ in routes]
+    pipelines = {path: UpdatePipeline(dp, workers=workers, queue_size=queue_size)
+                 for dp, path in routes}
+    app = create_app(pipelines)
+    metrics.gauge('update_queue_depth',
+                  lambda: sum(pipeline.depth() for pipeline in pipelines.values()))
+
+    async def startup(app):
+        if on_startup is not None:
+            await on_startup(dispatchers)
+        for dp, path in routes:
+            pipelines[path].start()
+            await dp.bot.set_webhook(webhook_url + path,
+                                     secret_token=pipelines[path].secret_token)
+
+    async def shutdown(app):
+        await asyncio.gather(*[pipeline.drain() for pipeline in pipelines.values()])
+        if on_shutdown is not None:
+            await on_shutdown(dispatchers)
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    app['pipelines'] = pipelines
+    # On SIGINT or SIGTERM aiohttp stops the server and runs the shutdown
+    # callbacks. The loop is the one aiogram bound the bots to at import time.
+    web.run_app(app, host=host, port=port, handle_signals=True, loop=asyncio.get_event_loop())